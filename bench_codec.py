@@ -0,0 +1,89 @@
+"""Micro-benchmark for the interpanZll frame codec.
+
+Compares the precompiled struct codec against the original field-by-field
+bellows implementation, reported as frames/sec:
+
+    python3 bench_codec.py [-n 20000]
+"""
+import argparse
+import time
+
+from bellows.types import named
+
+import interpanZll
+
+
+class LegacyEzspStruct(interpanZll.EzspStruct):
+    """The codec as it was before the struct layouts were precompiled"""
+
+    def set(self, name, val):
+        for field in self._fields:
+            if field[0] == name:
+                setattr(self, name, field[1](val))
+                return
+        raise Exception("no such field "+name)
+
+    def serialize(self):
+        r = b''
+        for field in self._fields:
+            r += getattr(self, field[0]).serialize()
+        return r
+
+    @classmethod
+    def deserialize(cls, data):
+        r = cls()
+        for field in cls._fields:
+            v, data = field[1].deserialize(data)
+            setattr(r, field[0], v)
+        return r, data
+
+
+def legacy(frame_cls):
+    return type("Legacy" + frame_cls.__name__, (LegacyEzspStruct,), {"_fields": frame_cls._fields})
+
+
+EUI_A = named.EmberEUI64.convert("00:11:22:33:44:55:66:77")
+EUI_B = named.EmberEUI64.convert("aa:bb:cc:dd:ee:ff:00:11")
+
+FRAMES = {
+    interpanZll.AckFrame: dict(seq=9),
+    interpanZll.ScanReq: dict(seq=1, srcPan=0, extSrc=EUI_A, transactionId=0xdeadbeef),
+    interpanZll.IdentifyReq: dict(seq=2, srcPan=0, extSrc=EUI_A, extDst=EUI_B, transactionId=7, frameControl=0xCC21),
+    interpanZll.FactoryResetReq: dict(seq=3, srcPan=0, extSrc=EUI_A, extDst=EUI_B, transactionId=7, frameControl=0xCC21),
+    interpanZll.ScanResp: dict(
+        seq=4, srcPan=0x1234, extSrc=EUI_B, extDst=EUI_A, transactionId=0xdeadbeef,
+        rSSICorrection=3, zigbeeInfo=1, zllInfo=2, keyMask=0x10, responseId=99, extPanId=1,
+        nwkUpdateId=1, logicalChannel=15, panId=0x4455, nwkAddr=1, numberSubDevices=1,
+        totalGroupIds=0, endpoint=11, profileId=0xc05e, deviceId=0x100, version=2, groupIdCount=0,
+    ),
+}
+
+
+def rate(fn, n):
+    start = time.perf_counter()
+    for _ in range(n):
+        fn()
+    return n / (time.perf_counter() - start)
+
+
+def main(n):
+    print(f"{'frame':<16} {'op':<12} {'before/s':>12} {'after/s':>12} {'speedup':>8}")
+    for frame_cls, kwargs in FRAMES.items():
+        old_cls = legacy(frame_cls)
+        old, new = old_cls(**kwargs), frame_cls(**kwargs)
+        data = new.serialize()
+        assert old.serialize() == data
+
+        for op, before, after in (
+            ("serialize", old.serialize, new.serialize),
+            ("deserialize", lambda: old_cls.deserialize(data), lambda: frame_cls.deserialize(data)),
+        ):
+            b, a = rate(before, n), rate(after, n)
+            print(f"{frame_cls.__name__:<16} {op:<12} {b:>12,.0f} {a:>12,.0f} {a / b:>7.1f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the interpanZll frame codec.')
+    parser.add_argument('-n', type=int, default=20000, help='Iterations per measurement (default: 20000)')
+    args = parser.parse_args()
+    main(args.n)
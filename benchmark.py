@@ -0,0 +1,308 @@
+"""Benchmark suite for the codec, the rx path and end-to-end scans.
+
+Everything runs against the simulated radio, so no stick is needed:
+
+    python3 benchmark.py [-o bench.json] [--compare previous.json] [--only codec,rx,scan,http,startup,replay]
+
+Results are written as JSON, one entry per benchmark with its unit and
+whether higher is better. --compare prints the change against an earlier
+run and exits non-zero when anything regressed by more than --threshold.
+"""
+import argparse
+import asyncio
+import importlib.util
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from bellows.types import named
+
+import interpanZll
+import hue_thief
+from bench_codec import FRAMES, EUI_A, rate
+from pcap_writer import PcapWriter
+from simulated_radio import SimulatedRadio
+
+HERE = Path(__file__).parent
+
+
+def throughput(value):
+    return {"value": value, "unit": "ops/s", "higher_is_better": True}
+
+
+def latency(samples):
+    samples = sorted(samples)
+    return {
+        "value": statistics.median(samples),
+        "unit": "s",
+        "higher_is_better": False,
+        "mean": statistics.fmean(samples),
+        "p95": samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+        "runs": len(samples),
+    }
+
+
+def best_rate(fn, n, repeat):
+    # Best of several runs, as timeit does, so other load on the box doesn't count
+    return max(rate(fn, n) for _ in range(repeat))
+
+
+def bench_codec(args):
+    results = {}
+    for frame_cls, kwargs in FRAMES.items():
+        frame = frame_cls(**kwargs)
+        data = frame.serialize()
+        name = frame_cls.__name__
+        results[f"codec.{name}.serialize"] = throughput(best_rate(frame.serialize, args.n, args.repeat))
+        results[f"codec.{name}.deserialize"] = throughput(best_rate(lambda: frame_cls.deserialize(data), args.n, args.repeat))
+    return results
+
+
+def rx_frames(count, transaction_id, match, malformed, seed=0):
+    """A shuffled mix of matching, malformed and non-matching mfglibRxHandler payloads"""
+    rng = random.Random(seed)
+    resp = dict(FRAMES[interpanZll.ScanResp], extDst=EUI_A)
+    bulbs = [named.EmberEUI64(rng.randbytes(8)) for _ in range(8)]
+
+    def scan_resp(tid):
+        return interpanZll.ScanResp(**dict(resp, extSrc=rng.choice(bulbs), transactionId=tid)).serialize()
+
+    frames = []
+    for _ in range(count):
+        r = rng.random()
+        if r < match:
+            frames.append(scan_resp(transaction_id))
+        elif r < match + malformed:
+            # Passes the header check, fails to decode
+            frames.append(scan_resp(transaction_id)[:40])
+        elif r < match + malformed + (1 - match - malformed) / 2:
+            frames.append(scan_resp(transaction_id ^ 1))
+        else:
+            frames.append(b"\x41\x88" + rng.randbytes(rng.randint(10, 60)))
+    return [(255, -60, frame) for frame in frames]
+
+
+def bench_rx(args):
+    async def run(pcap):
+        dev = SimulatedRadio(send_latency=0)
+        frames = rx_frames(args.n, 0xdeadbeef, args.match, args.malformed)
+        callback = processed = 0
+        for _ in range(args.repeat):
+            handler = hue_thief.ResponseHandler(dev, pcap, 11, 0xdeadbeef, max_queue=len(frames))
+            handler.start()
+            start = time.perf_counter()
+            for response in frames:
+                handler.handle_incoming("mfglibRxHandler", response)
+            queued = time.perf_counter()
+            # Let the worker decode everything queued, and the ACK sends finish
+            while handler.queue_depth:
+                await asyncio.sleep(0)
+            done = time.perf_counter()
+            await handler.stop()
+            callback = max(callback, len(frames) / (queued - start))
+            processed = max(processed, len(frames) / (done - start))
+        return callback, processed
+
+    with tempfile.TemporaryDirectory() as tmp:
+        pcap = PcapWriter(os.path.join(tmp, "bench.pcap"), max_queue=args.n * args.repeat * 3)
+        try:
+            callback, processed = asyncio.run(run(pcap))
+        finally:
+            pcap.close()
+    mix = {"match": args.match, "malformed": args.malformed}
+    return {"rx.callback": {**throughput(callback), "mix": mix},
+            "rx.handle_incoming": {**throughput(processed), "mix": mix}}
+
+
+def bench_scan(args):
+    async def run(pcap_path):
+        tl = await hue_thief.Touchlink.create(args.sim, 115200, pcap_path=pcap_path)
+        try:
+            samples = []
+            for _ in range(args.runs):
+                start = time.perf_counter()
+                await tl.scan_channel(11)
+                samples.append(time.perf_counter() - start)
+            return samples
+        finally:
+            await tl.close()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        return {"scan.scan_channel": latency(asyncio.run(run(os.path.join(tmp, "bench.pcap"))))}
+
+
+def load_server():
+    spec = importlib.util.spec_from_file_location("litestar_server", HERE / "litestar-server.py")
+    server = importlib.util.module_from_spec(spec)
+    # Litestar resolves handler annotations through sys.modules
+    sys.modules[spec.name] = server
+    spec.loader.exec_module(server)
+    return server
+
+
+def bench_http(args):
+    from litestar.testing import AsyncTestClient
+
+    server = load_server()
+
+    async def timed(client, url):
+        start = time.perf_counter()
+        response = await client.get(url)
+        response.raise_for_status()
+        return time.perf_counter() - start
+
+    async def run():
+        app = server.create_app([args.sim], 115200)
+        async with AsyncTestClient(app=app) as client:
+            refresh = [await timed(client, "/bulbs?channel=11&refresh=true") for _ in range(args.runs)]
+            cached = [await timed(client, "/bulbs?channel=11") for _ in range(args.runs)]
+        return refresh, cached
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        # The server writes log.pcap to the working directory
+        os.chdir(tmp)
+        try:
+            refresh, cached = asyncio.run(run())
+        finally:
+            os.chdir(cwd)
+    return {"http.bulbs.refresh": latency(refresh), "http.bulbs.cached": latency(cached)}
+
+
+def bench_startup(args):
+    """Cold start of a fresh interpreter: importing hue_thief, and the server's first HTTP response"""
+    import socket
+    import urllib.request
+
+    imports = []
+    for _ in range(args.runs):
+        out = subprocess.run([sys.executable, "-c", "import time; t = time.perf_counter(); import hue_thief; "
+                              "print(time.perf_counter() - t)"], cwd=HERE, capture_output=True, text=True, check=True)
+        imports.append(float(out.stdout))
+
+    first_response = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for _ in range(args.runs):
+            with socket.socket() as sock:
+                sock.bind(("127.0.0.1", 0))
+                port = sock.getsockname()[1]
+            start = time.perf_counter()
+            server = subprocess.Popen([sys.executable, str(HERE / "litestar-server.py"), args.sim, "--port", str(port)],
+                                      cwd=tmp, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            try:
+                while True:
+                    try:
+                        with urllib.request.urlopen(f"http://127.0.0.1:{port}/", timeout=1) as response:
+                            if response.status == 200:
+                                break
+                    except OSError:
+                        if server.poll() is not None:
+                            raise RuntimeError("Server exited during startup")
+                        time.sleep(0.01)
+                first_response.append(time.perf_counter() - start)
+            finally:
+                server.terminate()
+                server.wait()
+    return {"startup.import_hue_thief": latency(imports), "startup.first_response": latency(first_response)}
+
+
+def bench_replay(args):
+    """rx path throughput over a real capture, when one is given with --pcap"""
+    if not args.pcap:
+        print("No --pcap given, skipping replay")
+        return {}
+    start = time.perf_counter()
+    stats = hue_thief.replay_pcap(args.pcap)
+    result = throughput(stats.frames / (time.perf_counter() - start))
+    result["frames"] = stats.frames
+    return {"replay.frames": result}
+
+
+SUITES = {
+    "codec": bench_codec,
+    "rx": bench_rx,
+    "scan": bench_scan,
+    "http": bench_http,
+    "startup": bench_startup,
+    "replay": bench_replay,
+}
+
+
+def metadata():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=HERE,
+                                capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "version": os.environ.get("BUILD_VERSION", "local-dev"),
+        "commit": commit,
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+    }
+
+
+def compare(results, previous, threshold):
+    """Print the change against a previous run, returning the names that regressed"""
+    regressions = []
+    print(f"\n{'benchmark':<32} {'before':>12} {'after':>12} {'change':>8}")
+    for name, result in results.items():
+        old = previous.get(name)
+        if not old or not old["value"]:
+            continue
+        change = result["value"] / old["value"] - 1
+        worse = -change if result["higher_is_better"] else change
+        flag = "  REGRESSION" if worse > threshold else ""
+        if flag:
+            regressions.append(name)
+        print(f"{name:<32} {old['value']:>12.4g} {result['value']:>12.4g} {change:>+7.1%}{flag}")
+    return regressions
+
+
+def main(args):
+    results = {}
+    for suite in args.only:
+        print(f"Running {suite} benchmarks")
+        results.update(SUITES[suite](args))
+
+    for name, result in results.items():
+        print(f"{name:<32} {result['value']:>14.4g} {result['unit']}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"meta": metadata(), "results": results}, f, indent=2)
+        print(f"Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)["results"]
+        if compare(results, previous, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the codec, rx path and scans against the simulated radio.')
+    parser.add_argument('-o', '--output', default='bench.json', help='JSON results file (default: bench.json)')
+    parser.add_argument('--compare', help='Earlier JSON results to compare against')
+    parser.add_argument('--threshold', type=float, default=0.2, help='Relative slowdown reported as a regression (default: 0.2)')
+    parser.add_argument('--only', type=lambda s: s.split(','), default=list(SUITES), help=f'Comma separated suites (default: {",".join(SUITES)})')
+    parser.add_argument('-n', type=int, default=20000, help='Iterations for the codec and rx benchmarks (default: 20000)')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs of each throughput benchmark, the best is kept (default: 3)')
+    parser.add_argument('--match', type=float, default=0.05, help='Share of rx frames answering our scan (default: 0.05)')
+    parser.add_argument('--malformed', type=float, default=0.05, help='Share of rx frames that fail to decode (default: 0.05)')
+    parser.add_argument('--runs', type=int, default=5, help='Repetitions of the scan, HTTP and startup benchmarks (default: 5)')
+    parser.add_argument('--pcap', nargs='+', help='Captures for the replay benchmark, e.g. log.pcap from a real radio')
+    parser.add_argument('--sim', default='sim:bulbs=5,channels=11,noise=200,seed=1', help='Simulated radio spec for the scan and HTTP benchmarks')
+    args = parser.parse_args()
+    unknown = set(args.only) - set(SUITES)
+    if unknown:
+        parser.error(f"Unknown suites: {', '.join(sorted(unknown))}")
+    main(args)
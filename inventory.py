@@ -0,0 +1,107 @@
+"""On-disk inventory of every bulb ever seen, in SQLite.
+
+One row per bulb with its last channel, the deviceId/profileId/version from
+its ScanResp and first/last seen times, plus a capped RSSI history. The
+connection is shared between threads behind a lock so callers can write
+with asyncio.to_thread instead of blocking the event loop.
+"""
+import sqlite3
+import threading
+import time
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS bulbs (
+    ext_address TEXT PRIMARY KEY,
+    channel INTEGER NOT NULL,
+    device_id INTEGER,
+    profile_id INTEGER,
+    version INTEGER,
+    first_seen REAL NOT NULL,
+    last_seen REAL NOT NULL,
+    last_rssi INTEGER,
+    -- Set by a factory reset, the bulb leaves its channel afterwards
+    reset_at REAL
+);
+CREATE TABLE IF NOT EXISTS sightings (
+    ext_address TEXT NOT NULL,
+    seen REAL NOT NULL,
+    channel INTEGER NOT NULL,
+    rssi INTEGER,
+    signal_strength INTEGER
+);
+CREATE INDEX IF NOT EXISTS sightings_by_bulb ON sightings (ext_address, seen);
+"""
+
+
+class Inventory:
+    def __init__(self, path, history=200):
+        self.path = path
+        # Sightings kept per bulb, older ones are dropped
+        self.history = history
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        with self._lock, self._db:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.executescript(_SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def record(self, targets, seen=None):
+        """Store one scan's targets"""
+        seen = seen or time.time()
+        with self._lock, self._db:
+            for t in targets:
+                self._db.execute(
+                    "INSERT INTO bulbs (ext_address, channel, device_id, profile_id, version, first_seen, last_seen, last_rssi) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT (ext_address) DO UPDATE SET channel = excluded.channel, "
+                    "device_id = coalesce(excluded.device_id, device_id), "
+                    "profile_id = coalesce(excluded.profile_id, profile_id), "
+                    "version = coalesce(excluded.version, version), "
+                    "last_seen = excluded.last_seen, last_rssi = excluded.last_rssi",
+                    (t.ext_address, t.channel, t.device_id, t.profile_id, t.version, seen, seen, t.rssi),
+                )
+                self._db.execute(
+                    "INSERT INTO sightings (ext_address, seen, channel, rssi, signal_strength) VALUES (?, ?, ?, ?, ?)",
+                    (t.ext_address, seen, t.channel, t.rssi, t.signal_strength),
+                )
+                self._db.execute(
+                    "DELETE FROM sightings WHERE ext_address = ? AND seen < ("
+                    "SELECT seen FROM sightings WHERE ext_address = ? ORDER BY seen DESC LIMIT 1 OFFSET ?)",
+                    (t.ext_address, t.ext_address, self.history - 1),
+                )
+
+    def mark_reset(self, ext_address, when=None):
+        with self._lock, self._db:
+            self._db.execute("UPDATE bulbs SET reset_at = ? WHERE ext_address = ?", (when or time.time(), ext_address))
+
+    def known(self, max_age=None) -> dict[str, int]:
+        """ext_address -> channel of bulbs expected to still answer: seen within
+        max_age seconds and not factory reset since.
+        """
+        since = time.time() - max_age if max_age else 0
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT ext_address, channel FROM bulbs WHERE last_seen >= ? "
+                "AND (reset_at IS NULL OR reset_at < last_seen)", (since,)).fetchall()
+        return {row["ext_address"]: row["channel"] for row in rows}
+
+    def bulbs(self) -> list[dict]:
+        with self._lock:
+            rows = self._db.execute("SELECT * FROM bulbs ORDER BY last_seen DESC").fetchall()
+        return [dict(row) for row in rows]
+
+    def get(self, ext_address, limit=None) -> dict | None:
+        """One bulb with its RSSI history, newest first"""
+        with self._lock:
+            row = self._db.execute("SELECT * FROM bulbs WHERE ext_address = ?", (ext_address,)).fetchone()
+            if row is None:
+                return None
+            sightings = self._db.execute(
+                "SELECT seen, channel, rssi, signal_strength FROM sightings WHERE ext_address = ? "
+                "ORDER BY seen DESC LIMIT ?", (ext_address, limit or self.history)).fetchall()
+        return {**dict(row), "sightings": [dict(s) for s in sightings]}
@@ -1,30 +1,46 @@
+import time
+# Startup phases are measured from here, see record_startup
+STARTED = time.perf_counter()
+
 import argparse
 import asyncio
+import heapq
+import html
+import itertools
+import json
 import logging
 import sys
+from collections import Counter, defaultdict
 from dataclasses import dataclass
 from pathlib import Path
 import os
-from typing import Annotated
+from typing import Annotated, AsyncGenerator
 
 import litestar.exceptions
-from litestar import Litestar, get, post, Controller, MediaType
+from litestar import Litestar, Request, get, post, Controller, MediaType
 from litestar.contrib.htmx.request import HTMXRequest
 from litestar.contrib.htmx.response import Reswap, HTMXTemplate
 from litestar.contrib.jinja import JinjaTemplateEngine
 from litestar.config.cors import CORSConfig
 from litestar.datastructures import State
 from litestar.params import Parameter
-from litestar.response import Template
+from litestar.response import File, ServerSentEvent, ServerSentEventMessage, Template
 from litestar.template import TemplateConfig
+from litestar.types import ASGIApp, Receive, Scope, Send
 
 import pydantic
 
+import metrics
+import tracing
+from inventory import Inventory
+from radio_scheduler import RadioScheduler, COMMAND_PRIORITY, SCAN_PRIORITY
+
 logger = logging.getLogger(__name__)
 
 # Generate skeletons for Windows only
 try:
-    from hue_thief import steal, prepare_config, Touchlink, Target
+    from hue_thief import prepare_config, Touchlink, Target, ChannelScheduler, TargetCache, DeliveryError, ALL_CHANNELS, \
+        DEFAULT_SCAN_REPEATS, RadioPool, merge_targets, incremental_sweep
 except ImportError:
     if os.name == "nt":
         @dataclass
@@ -37,15 +53,22 @@ except ImportError:
         class Touchlink:
 
             def __init__(self, *args, **kwargs):
-                pass
+                # Read by /metrics, nothing is received or written here
+                self.channel_stats = defaultdict(Counter)
+                self.pcap = None
+                self.rx_queue_depth = 0
+                self.rx_dropped = 0
 
             @classmethod
-            async def create(cls, device_path, baud_rate):
+            async def create(cls, device_path, baud_rate, **kwargs):
                 return cls()
 
-            async def scan_channel(self, channel, *args, **kwargs):
+            async def scan_channel(self, channel, *args, on_target=None, **kwargs):
                 await asyncio.sleep(0.5)
-                return [Target("abc", 123, 11, channel)]
+                target = Target("abc", 123, 11, channel)
+                if on_target:
+                    on_target(target)
+                return [target]
                 #return set()
 
             async def identify_bulb(self, *args, **kwargs):
@@ -57,11 +80,6 @@ except ImportError:
             async def close(self):
                 pass
 
-        async def steal(*args, **kwargs):
-            await asyncio.sleep(2)
-            return set([("abc", 123, 11)])
-            #return set()
-
         async def identify_bulb(*args, **kwargs):
             await asyncio.sleep(2)
             pass
@@ -73,24 +91,86 @@ except ImportError:
         async def prepare_config(*args, **kwargs):
             return ("dev", "euifake")
 
+        ALL_CHANNELS = tuple(range(11, 27))
+        DEFAULT_SCAN_REPEATS = 2
+
+        class DeliveryError(Exception):
+            pass
+
+        class RadioPool:
+            def __init__(self, radios):
+                self.radios = radios
+                self.channel_scheduler = radios[0].channel_scheduler
+                self.target_cache = radios[0].target_cache
+
+            async def submit(self, operation, channel=None, priority=SCAN_PRIORITY):
+                return await self.radios[0].submit(operation, channel=channel, priority=priority)
+
+            async def scan_channels(self, channels, **scan_kwargs):
+                for c in channels:
+                    yield c, await self.submit(lambda tl: tl.scan_channel(c, **scan_kwargs), channel=c)
+
+            async def close(self):
+                for radio in self.radios:
+                    await radio.close()
+
+        def merge_targets(targets):
+            return list(targets)
+
+        async def incremental_sweep(scan_channels, known, channels):
+            return [t async for c, targets in scan_channels(channels) for t in targets]
+
+        class ChannelScheduler:
+            def order(self, channels=ALL_CHANNELS):
+                return list(channels)
+
+        class TargetCache:
+            def __init__(self, ttl=300):
+                self.ttl = ttl
+
+            def fresh(self, channels):
+                return False
+
+            def get(self, ext_address):
+                return None
+
+            def invalidate(self, ext_address=None):
+                pass
+
     else:
         raise
 
+# hue_thief defers bellows until a radio is opened, so this is mostly litestar
+IMPORT_SECONDS = time.perf_counter() - STARTED
+
 
 # Pydantic models for request parameters
 # @dataclass
 # class IdentifyBulbRequest:
 class IdentifyBulbRequest(pydantic.BaseModel):
     address: str
-    transaction_id: int
-    channel: int
+    # Looked up in the scan cache when not given
+    transaction_id: int | None = None
+    channel: int | None = None
 
 # @dataclass
 # class ResetBulbRequest:
 class ResetBulbRequest(pydantic.BaseModel):
     address: str
-    transaction_id: int
-    channel: int
+    # Looked up in the scan cache when not given
+    transaction_id: int | None = None
+    channel: int | None = None
+
+
+class BulkBulbsRequest(pydantic.BaseModel):
+    bulbs: list[IdentifyBulbRequest]
+
+
+class BulkResult(pydantic.BaseModel):
+    address: str
+    channel: int | None
+    ok: bool
+    detail: str | None = None
 
 
 # @dataclass
@@ -100,97 +180,538 @@ class Bulb(pydantic.BaseModel):
     transaction_id: int
     channel: int
     signal_strength: int
+    rssi: int | None = None
+    age_s: float | None = None
+    device_id: int | None = None
+    profile_id: int | None = None
+    version: int | None = None
 
     def from_target(target):
-        return Bulb(address=target.ext_address, transaction_id=target.transaction_id, channel=target.channel, signal_strength=target.signal_strength)
+        return Bulb(address=target.ext_address, transaction_id=target.transaction_id, channel=target.channel, signal_strength=target.signal_strength,
+                    rssi=getattr(target, "rssi", None), age_s=getattr(target, "age", None),
+                    device_id=getattr(target, "device_id", None), profile_id=getattr(target, "profile_id", None),
+                    version=getattr(target, "version", None))
 
 
 @dataclass
 class BulbsResponse:
     bulbs: list[Bulb]
 
+class RadioSession:
+    """Long-lived Touchlink connection shared by every request.
+
+    Opening the stick (EZSP reset, getEui64, mfglibStart) takes seconds, so it
+    is done once at startup and reused. If the stick drops the session is torn
+    down and reopened on the next call.
+    """
+    reconnect_errors = (ConnectionError, OSError, asyncio.TimeoutError)
+
+    def __init__(self, device_path, baud_rate, channel_scheduler, target_cache, pcap_path="log.pcap", inventory=None,
+                 scan_repeats=DEFAULT_SCAN_REPEATS):
+        self.device_path = device_path
+        self.baud_rate = baud_rate
+        self.pcap_path = pcap_path
+        self.scan_repeats = scan_repeats
+        self.touchlink = None
+        # Shared with the other sticks, and kept here so scan history and
+        # results survive reconnects
+        self.channel_scheduler = channel_scheduler
+        self.target_cache = target_cache
+        self.inventory = inventory
+        # Every operation on this stick goes through here, the Touchlink's
+        # own scans included, and it survives reconnects
+        self.scheduler = RadioScheduler(self.run)
+        self._connect_lock = asyncio.Lock()
+
+    async def connect(self):
+        async with self._connect_lock:
+            if self.touchlink is None:
+                logger.info(f"Opening radio on {self.device_path} at {self.baud_rate}")
+                self.touchlink = await Touchlink.create(self.device_path, self.baud_rate,
+                                                        channel_scheduler=self.channel_scheduler,
+                                                        target_cache=self.target_cache,
+                                                        pcap_path=self.pcap_path,
+                                                        inventory=self.inventory,
+                                                        scan_repeats=self.scan_repeats,
+                                                        scheduler=self.scheduler)
+            return self.touchlink
+
+    async def close(self):
+        await self.scheduler.close()
+        await self.disconnect()
+
+    async def disconnect(self):
+        async with self._connect_lock:
+            touchlink, self.touchlink = self.touchlink, None
+            if touchlink is not None:
+                try:
+                    await touchlink.close()
+                except Exception as e:
+                    logger.warning(f"Error closing radio: {e}")
+
+    async def submit(self, operation, channel=None, priority=SCAN_PRIORITY):
+        """Queue ``operation(touchlink)`` on the scheduler and wait for its result"""
+        return await self.scheduler.submit(operation, channel=channel, priority=priority)
+
+    async def run(self, operation):
+        """Run ``operation(touchlink)``, reconnecting once if the stick has dropped"""
+        touchlink = await self.connect()
+        try:
+            return await operation(touchlink)
+        except self.reconnect_errors as e:
+            logger.warning(f"Radio error, reconnecting: {e}")
+            await self.disconnect()
+            touchlink = await self.connect()
+            return await operation(touchlink)
+
+
+class RadioGroup(RadioPool):
+    """Every stick the server was started with, as a RadioPool of RadioSessions.
+
+    Sharding, submit and scan_channels are RadioPool's, this only adds
+    opening the sessions and the server's shared state.
+    """
+
+    def __init__(self, device_paths, baud_rate, cache_ttl=300, inventory=None, scan_repeats=DEFAULT_SCAN_REPEATS):
+        channel_scheduler = ChannelScheduler()
+        target_cache = TargetCache(cache_ttl)
+        super().__init__([
+            RadioSession(device_path, baud_rate, channel_scheduler, target_cache,
+                         pcap_path="log.pcap" if n == 0 else f"log.{n}.pcap", inventory=inventory,
+                         scan_repeats=scan_repeats)
+            for n, device_path in enumerate(device_paths)
+        ])
+        # Optional on-disk record of every bulb seen, see inventory.py
+        self.inventory = inventory
+        # Running sweeps keyed by their channel set, shared by concurrent requests
+        self.inflight_scans = {}
+
+    @property
+    def sessions(self) -> list[RadioSession]:
+        return self.radios
+
+    @property
+    def touchlink(self):
+        """The first stick's Touchlink, see touchlinks for all of them"""
+        return self.sessions[0].touchlink
+
+    @property
+    def touchlinks(self) -> list[tuple[str, object]]:
+        """(device path, Touchlink) for every stick that is open"""
+        return [(session.device_path, session.touchlink) for session in self.sessions if session.touchlink is not None]
+
+    async def connect(self):
+        await asyncio.gather(*(session.connect() for session in self.sessions))
+
+    async def close(self):
+        await super().close()
+        if self.inventory is not None:
+            self.inventory.close()
+
+    def stats(self) -> list[dict]:
+        return [{"device": session.device_path, **session.scheduler.stats()} for session in self.sessions]
+
+    def metrics(self) -> list:
+        """Metrics read from the radios at scrape time rather than counted twice"""
+        frames = metrics.Counter("hue_thief_frames_received_total", "Frames received while scanning",
+                                 ["device", "channel", "kind"])
+        pcap_queue = metrics.Gauge("hue_thief_pcap_queue_depth", "Frames waiting for the pcap writer", ["device"])
+        pcap_dropped = metrics.Counter("hue_thief_pcap_dropped_total", "Frames the pcap writer dropped", ["device"])
+        scheduler_queue = metrics.Gauge("hue_thief_scheduler_queue_depth", "Operations queued for the radio", ["device"])
+        rx_queue = metrics.Gauge("hue_thief_rx_queue_depth", "Received frames waiting to be decoded", ["device"])
+        rx_dropped = metrics.Counter("hue_thief_rx_dropped_total", "Received frames dropped because the decode queue was full", ["device"])
+        for session in self.sessions:
+            device = session.device_path
+            scheduler_queue.set(session.scheduler.queue_depth, device)
+            touchlink = session.touchlink
+            if touchlink is None:
+                continue
+            for channel, counts in touchlink.channel_stats.items():
+                for kind, count in counts.items():
+                    frames.inc(device, channel, kind, amount=count)
+            if touchlink.pcap is not None:
+                pcap_queue.set(touchlink.pcap.queue_depth, device)
+                pcap_dropped.inc(device, amount=touchlink.pcap.dropped)
+            rx_queue.set(touchlink.rx_queue_depth, device)
+            rx_dropped.inc(device, amount=touchlink.rx_dropped)
+        return [frames, pcap_queue, pcap_dropped, scheduler_queue, rx_queue, rx_dropped]
+
+
+# Most frames one /captures request returns
+MAX_CAPTURE_PAGE = 1000
+
+
+class SharedScan:
+    """One sweep shared by every request for the same channels.
+
+    The sweep publishes ("bulb", Target) and ("progress", dict) events as it
+    goes. Subscribers joining late get the events they missed first, then the
+    live ones, and task holds the merged result for /bulbs.
+    """
+    def __init__(self, sweep):
+        self.events = []
+        self.subscribers = []
+        self.task = asyncio.create_task(sweep(self.publish))
+        # None marks the end for subscribers
+        self.task.add_done_callback(lambda _: self.publish(None))
+
+    def publish(self, event):
+        self.events.append(event)
+        for queue in self.subscribers:
+            queue.put_nowait(event)
+
+    async def subscribe(self) -> AsyncGenerator[tuple[str, object], None]:
+        queue = asyncio.Queue()
+        for event in self.events:
+            queue.put_nowait(event)
+        self.subscribers.append(queue)
+        try:
+            while (event := await queue.get()) is not None:
+                yield event
+            # Raise any scan error to the subscriber
+            self.task.result()
+        finally:
+            self.subscribers.remove(queue)
+
+
 # Class for handling all bulb routes
 class BulbRoutes(Controller):
-    method_lock = asyncio.Lock()
-
-    async def bulbs(self, state: State, channel: int | None) -> BulbsResponse:
-        channels = [channel] if channel else range(11, 27)
-        async with self.method_lock:
-            touchlink = await Touchlink.create(state.device_path, state.baud_rate)
-            all_bulbs = []
-            for c in channels:
-                logging.debug(f"Scanning on channel {c}")
-                bulbs = await touchlink.scan_channel(c)
-                all_bulbs.extend(bulbs)
-            await touchlink.close()
-
-            res = BulbsResponse(bulbs=[Bulb.from_target(bulb) for bulb in all_bulbs])
-            return res
+    async def sweep(self, state: State, channels, incremental, publish) -> list[Target]:
+        all_bulbs = []
+        with tracing.span("sweep", channels=len(channels), incremental=incremental):
+            inventory = state.radio.inventory
+            if incremental and inventory is not None:
+                known = await asyncio.to_thread(inventory.known, state.inventory_max_age)
+                all_bulbs = await incremental_sweep(state.radio.scan_channels, known, channels)
+            else:
+                async for c, bulbs in state.radio.scan_channels(channels, on_target=lambda t: publish(("bulb", t))):
+                    all_bulbs.extend(bulbs)
+                    publish(("progress", {"channel": c, "found": len(bulbs)}))
+        # The same bulb can answer more than one stick
+        return merge_targets(all_bulbs)
+
+    def shared_scan(self, state: State, channels, incremental=False) -> SharedScan:
+        """The running sweep of channels, or a new one.
+
+        Requests for the same channels while a sweep is running share it,
+        whether they want the bulb list or the event stream.
+        """
+        key = (tuple(sorted(channels)), incremental)
+        scan = state.radio.inflight_scans.get(key)
+        metrics.SWEEPS.inc("shared" if scan else "radio")
+        if scan is None:
+            scan = SharedScan(lambda publish: self.sweep(state, channels, incremental, publish))
+            state.radio.inflight_scans[key] = scan
+            scan.task.add_done_callback(lambda _: state.radio.inflight_scans.pop(key, None))
+        return scan
+
+    async def bulbs(self, state: State, channel: int | None, refresh: bool = False, incremental: bool = False) -> BulbsResponse:
+        channels = [channel] if channel else ALL_CHANNELS
+        cache = state.radio.target_cache
+        if not refresh and cache.fresh(channels):
+            metrics.SWEEPS.inc("cache")
+            return BulbsResponse(bulbs=[Bulb.from_target(bulb) for bulb in cache.targets_for(channels)])
+
+        with tracing.profile("bulbs"):
+            # Shielded so one client going away doesn't cancel the others' scan
+            all_bulbs = await asyncio.shield(self.shared_scan(state, channels, incremental).task)
+
+        res = BulbsResponse(bulbs=[Bulb.from_target(bulb) for bulb in all_bulbs])
+        return res
+
+    async def scan_events(self, state: State, channel: int | None) -> AsyncGenerator[tuple[str, object], None]:
+        """Scan, yielding ("bulb", Target) as soon as each bulb answers and
+        ("progress", dict) as each channel finishes.
+
+        Joins a sweep of the same channels that is already running rather
+        than starting another, see SharedScan.
+        """
+        channels = [channel] if channel else ALL_CHANNELS
+        n = 0
+        async for event, payload in self.shared_scan(state, channels).subscribe():
+            if event == "progress":
+                n += 1
+                payload = {"channel": payload["channel"], "scanned": n, "total": len(channels), "found": payload["found"]}
+            yield event, payload
+
+    async def resolve_target(self, state: State, address: str, transaction_id: int | None, channel: int | None) -> tuple[int, int]:
+        """Fill in a bulb's transaction id and channel from the scan cache.
+
+        The bulb's channel is rescanned if its cached transaction has expired,
+        since bulbs ignore identify and reset for stale ones. The rescan is
+        queued at COMMAND_PRIORITY.
+        """
+        cache = state.radio.target_cache
+        target = cache.get(address)
+        channel = channel or (target.channel if target else None)
+        if channel is None:
+            raise litestar.exceptions.NotFoundException(f"Unknown bulb {address}, scan for it first")
+
+        if not (target and target.transaction_valid):
+            await state.radio.submit(lambda tl: tl.scan_channel(channel), channel=channel, priority=COMMAND_PRIORITY)
+            target = cache.get(address)
+        if target is not None:
+            return target.transaction_id, target.channel
+        if transaction_id is None:
+            # Not cached and didn't answer a rescan, bulbs ignore commands without a transaction
+            raise litestar.exceptions.NotFoundException(f"No transaction for bulb {address}, scan for it first")
+        return transaction_id, channel
 
     @get("/bulbs")
-    async def get_bulbs(self, state: State, channel: int | None) -> BulbsResponse:
+    async def get_bulbs(self, state: State, channel: int | None, refresh: bool = False, incremental: bool = False) -> BulbsResponse:
+        """With incremental, channels known bulbs were last seen on are scanned
+        first and the sweep stops there if they all answer, see hue_thief.incremental_sweep
+        """
         try:
-            return await self.bulbs(state, channel)
+            return await self.bulbs(state, channel, refresh, incremental)
         except Exception as e:
             raise litestar.exceptions.HTTPException from e
 
+    @post("/bulbs/invalidate")
+    async def invalidate_bulbs(self, state: State, address: str | None = None) -> None:
+        state.radio.target_cache.invalidate(address)
+
     @get("/bulbs_htmx")
-    async def get_bulbs_htmx(self, state: State, channel: int | None, ingress_url: Annotated[str | None, Parameter(header="X-Ingress-Path")],) -> Reswap:
-        bulbs = await self.bulbs(state, channel)
+    async def get_bulbs_htmx(self, state: State, channel: int | None, ingress_url: Annotated[str | None, Parameter(header="X-Ingress-Path")], refresh: bool = False, incremental: bool = False) -> Reswap:
+        bulbs = await self.bulbs(state, channel, refresh, incremental)
         host = ingress_url or ""
         template = HTMXTemplate(template_name="bulb_table.html", context={"bulbs": bulbs.bulbs, "ingress_host": host}, re_swap="InnerHTML")#, re_target="bulbs-content")
         return template
 
 
+    @get("/bulbs_stream")
+    async def get_bulbs_stream(self, state: State, channel: int | None) -> ServerSentEvent:
+        async def stream():
+            try:
+                async for event, payload in self.scan_events(state, channel):
+                    if event == "bulb":
+                        payload = Bulb.from_target(payload).model_dump()
+                    yield ServerSentEventMessage(event=event, data=json.dumps(payload))
+            except Exception as e:
+                logger.exception("Streaming scan failed")
+                yield ServerSentEventMessage(event="error", data=json.dumps({"error": str(e)}))
+            yield ServerSentEventMessage(event="done", data="{}")
+
+        return ServerSentEvent(stream())
+
+    @get("/scan_htmx")
+    async def get_scan_htmx(self, channel: int | None, ingress_url: Annotated[str | None, Parameter(header="X-Ingress-Path")],) -> Reswap:
+        host = ingress_url or ""
+        return HTMXTemplate(template_name="scan_stream.html", context={"channel": channel, "ingress_host": host}, re_swap="InnerHTML")
+
+    @get("/bulbs_stream_htmx")
+    async def get_bulbs_stream_htmx(self, request: Request, state: State, channel: int | None, ingress_url: Annotated[str | None, Parameter(header="X-Ingress-Path")],) -> ServerSentEvent:
+        host = ingress_url or ""
+        row = request.app.template_engine.get_template("bulb_row.html")
+
+        async def stream():
+            bulbs = 0
+            try:
+                async for event, payload in self.scan_events(state, channel):
+                    if event == "bulb":
+                        bulbs += 1
+                        yield ServerSentEventMessage(event="bulb", data=row.render(bulb=Bulb.from_target(payload), ingress_host=host))
+                    else:
+                        status = f"Scanned channel {payload['channel']} ({payload['scanned']}/{payload['total']}), {bulbs} bulbs found"
+                        yield ServerSentEventMessage(event="progress", data=status)
+                done = f"Scan finished, {bulbs} bulbs found"
+            except Exception as e:
+                logger.exception("Streaming scan failed")
+                done = f"Scan failed: {html.escape(str(e))}"
+            # Replacing the status element also disconnects the event source
+            yield ServerSentEventMessage(event="done", data=done)
+
+        return ServerSentEvent(stream())
+
     @post("/identify_bulb")
     async def identify_bulb(self, state: State, data: IdentifyBulbRequest) -> None:
-        async with self.method_lock:
-            touchlink = await Touchlink.create(state.device_path, state.baud_rate)
-            result = await touchlink.identify_bulb(data.address, data.transaction_id, data.channel)
-            await touchlink.close()
+        transaction_id, channel = await self.resolve_target(state, data.address, data.transaction_id, data.channel)
+        result = await state.radio.submit(lambda tl: tl.identify_bulb(data.address, transaction_id, channel),
+                                          channel=channel, priority=COMMAND_PRIORITY)
         return litestar.Response(status_code=200, content="Flashing bulb")
 
     @post("/identify_bulb_htmx")
     async def identify_bulb_htmx(self, state: State, data: IdentifyBulbRequest) -> None:
-        async with self.method_lock:
-            touchlink = await Touchlink.create(state.device_path, state.baud_rate)
-            result = await touchlink.identify_bulb(data.address, data.transaction_id, data.channel)
-            # result = await identify_bulb(state.radio_config[0], state.radio_config[1], "fdsfds", data.transaction_id, data.channel)
-            await touchlink.close()
+        transaction_id, channel = await self.resolve_target(state, data.address, data.transaction_id, data.channel)
+        result = await state.radio.submit(lambda tl: tl.identify_bulb(data.address, transaction_id, channel),
+                                          channel=channel, priority=COMMAND_PRIORITY)
         return litestar.Response(status_code=200, content="Flashing bulb")
 
     @post("/reset_bulb")
     async def post_reset_bulb(self, state: State, data: ResetBulbRequest) -> None:
-        async with self.method_lock:
-            touchlink = await Touchlink.create(state.device_path, state.baud_rate)
-            result = await touchlink.send_reset(data.address, data.transaction_id, data.channel)
-            await touchlink.close()
+        transaction_id, channel = await self.resolve_target(state, data.address, data.transaction_id, data.channel)
+        result = await state.radio.submit(lambda tl: tl.send_reset(data.address, transaction_id, channel),
+                                          channel=channel, priority=COMMAND_PRIORITY)
+        state.radio.target_cache.invalidate(data.address)
+        if state.radio.inventory is not None:
+            await asyncio.to_thread(state.radio.inventory.mark_reset, data.address)
         return litestar.Response(status_code=200, content="Bulb reset")
 
-def make_config(device_path, baudrate):
-    async def get_db_connection(app: Litestar) -> tuple:
+    async def bulk(self, state: State, bulbs: list[IdentifyBulbRequest], send) -> list[BulkResult]:
+        """Run ``send(touchlink, address, transaction_id, channel)`` for every bulb.
+
+        Everything is queued at once so the scheduler batches the commands by
+        channel. Failures are reported per bulb rather than aborting the batch.
+        """
+        # Rescan each channel with expired transactions once, not once per bulb
+        cache = state.radio.target_cache
+        stale = set()
+        for bulb in bulbs:
+            target = cache.get(bulb.address)
+            channel = bulb.channel or (target.channel if target else None)
+            if channel and not (target and target.transaction_valid):
+                stale.add(channel)
+        await asyncio.gather(*(
+            state.radio.submit(lambda tl, c=c: tl.scan_channel(c), channel=c, priority=COMMAND_PRIORITY)
+            for c in stale
+        ))
+
+        async def one(bulb):
+            channel = bulb.channel
+            try:
+                transaction_id, channel = await self.resolve_target(state, bulb.address, bulb.transaction_id, bulb.channel)
+                await state.radio.submit(lambda tl: send(tl, bulb.address, transaction_id, channel),
+                                         channel=channel, priority=COMMAND_PRIORITY)
+                return BulkResult(address=bulb.address, channel=channel, ok=True)
+            except Exception as e:
+                logger.warning(f"Bulk command to {bulb.address} failed: {e}")
+                return BulkResult(address=bulb.address, channel=channel, ok=False, detail=str(e))
+
+        return list(await asyncio.gather(*(one(bulb) for bulb in bulbs)))
+
+    @post("/identify_bulbs")
+    async def identify_bulbs(self, state: State, data: BulkBulbsRequest) -> list[BulkResult]:
+        return await self.bulk(state, data.bulbs, lambda tl, *args: tl.identify_bulb(*args))
+
+    @post("/reset_bulbs")
+    async def reset_bulbs(self, state: State, data: BulkBulbsRequest) -> list[BulkResult]:
+        results = await self.bulk(state, data.bulbs, lambda tl, *args: tl.send_reset(*args))
+        for r in results:
+            if r.ok:
+                state.radio.target_cache.invalidate(r.address)
+                if state.radio.inventory is not None:
+                    await asyncio.to_thread(state.radio.inventory.mark_reset, r.address)
+        return results
+
+    @get("/inventory")
+    async def get_inventory(self, state: State) -> list[dict]:
+        """Every bulb ever seen, most recent first"""
+        if state.radio.inventory is None:
+            return []
+        return await asyncio.to_thread(state.radio.inventory.bulbs)
+
+    @get("/inventory/{address:str}")
+    async def get_inventory_bulb(self, state: State, address: str, limit: int = 100) -> dict:
+        """One bulb with its RSSI history"""
+        bulb = None
+        if state.radio.inventory is not None:
+            bulb = await asyncio.to_thread(state.radio.inventory.get, address, limit)
+        if bulb is None:
+            raise litestar.exceptions.NotFoundException(f"Bulb {address} has never been seen")
+        return bulb
+
+    @get("/scheduler")
+    async def get_scheduler(self, state: State) -> dict:
+        return {"radios": state.radio.stats()}
+
+    @get("/captures")
+    async def get_captures(self, state: State, kind: str = "valid", offset: Annotated[int, Parameter(ge=0)] = 0,
+                           limit: Annotated[int, Parameter(ge=0, le=MAX_CAPTURE_PAGE)] = 100) -> dict:
+        """Frames captured by every stick, oldest first, each with the device that received it"""
+        if kind not in ("valid", "invalid"):
+            raise litestar.exceptions.ValidationException(f"Unknown capture kind {kind}")
+        buffers = [(device, buffer) for device, touchlink in state.radio.touchlinks
+                   if (buffer := getattr(touchlink, f"{kind}_responses", None)) is not None]
+
+        def frames(device, buffer):
+            for frame in buffer:
+                yield {**frame.to_dict(), "device": device}
+
+        merged = heapq.merge(*(frames(device, buffer) for device, buffer in buffers), key=lambda frame: frame["timestamp"])
+        return {
+            "total": sum(len(buffer) for _, buffer in buffers),
+            "dropped": sum(buffer.dropped for _, buffer in buffers),
+            "frames": list(itertools.islice(merged, offset, offset + limit)),
+        }
+
+_startup_recorded = set()
+
+def record_startup(phase):
+    """Log and export the seconds from process start to phase, once per phase"""
+    if phase in _startup_recorded:
+        return
+    _startup_recorded.add(phase)
+    seconds = time.perf_counter() - STARTED
+    metrics.STARTUP_SECONDS.set(seconds, phase)
+    logger.info(f"Startup: {phase} after {seconds:.3f}s")
+
+
+async def connect_radio(radio: RadioGroup) -> None:
+    try:
+        await radio.connect()
+    except Exception as e:
+        # Keep serving the UI, the session will retry on the first request
+        logger.warning(f"Unable to open radio at startup: {e}")
+        return
+    record_startup("radio_ready")
+
+
+def make_config(device_paths, baudrate, cache_ttl=300, inventory_path=None, inventory_max_age=None,
+                scan_repeats=DEFAULT_SCAN_REPEATS):
+    async def open_radio(app: Litestar) -> RadioGroup:
         print("Preparing config")
-        app.state.device_path = device_path
+        metrics.STARTUP_SECONDS.set(IMPORT_SECONDS, "import")
+        app.state.device_path = ", ".join(device_paths)
         app.state.baud_rate = baudrate
-        # if not getattr(app.state, "radio_config", None):
-        #     dev, eui64 = await prepare_config(device_path, baudrate)
-        #     app.state.radio_config = (dev, eui64)
-        # print(f"dev: {type(app.state.radio_config[0])} - {app.state.radio_config[0]}, eui64: {type(app.state.radio_config[1])} - {app.state.radio_config[1]}")
+        app.state.inventory_max_age = inventory_max_age
+        inventory = Inventory(inventory_path) if inventory_path else None
+        app.state.radio = RadioGroup(device_paths, baudrate, cache_ttl, inventory, scan_repeats)
+        # Opening the sticks takes seconds, serve the UI meanwhile. Radio
+        # requests queue on the session's connect lock until it is open.
+        app.state.radio_connect = asyncio.create_task(connect_radio(app.state.radio))
+        return app.state.radio
+
+    return open_radio
+
+
+async def close_radio(app: Litestar) -> None:
+    """Closes the radio session stored in the application State object."""
+    connect = getattr(app.state, "radio_connect", None)
+    if connect:
+        connect.cancel()
+    radio = getattr(app.state, "radio", None)
+    if radio:
+        await radio.close()
+
+
+def request_timing_middleware(app: ASGIApp) -> ASGIApp:
+    """Records hue_thief_http_request_seconds by route template, so paths with ids don't blow up the labels"""
+    async def middleware(scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
 
-        app.state.device_path = device_path
-        app.state.baud_rate = baudrate
-        # return app.state.radio_config
-
-    return get_db_connection
+        try:
+            await app(scope, receive, send_wrapper)
+        finally:
+            metrics.HTTP_SECONDS.observe(time.perf_counter() - start, scope["method"],
+                                         scope.get("path_template", "unknown"), status)
+            record_startup("first_response")
 
+    return middleware
 
-async def close_db_connection(app: Litestar) -> None:
-    """Closes the db connection stored in the application State object."""
-    if getattr(app.state, "engine", None):
-        dev, eui64 = app.state.radio_config
 
-        await dev.mfglibEnd()
-        dev.close()
+def delivery_error_handler(request: Request, exc: DeliveryError) -> litestar.Response:
+    """The bulb never acknowledged the command, report it rather than claiming success"""
+    return litestar.Response(status_code=504, content=str(exc))
 
 
 @get("/", media_type=MediaType.HTML)
@@ -203,25 +724,61 @@ async def index(state: State, ingress_url: Annotated[str | None, Parameter(heade
     return Template("index.html", context={"device_path": state.device_path, "baud_rate": state.baud_rate, "ingress_host": host})
     # return index.read_text()
 
+def create_app(device_paths, baudrate, cache_ttl=300, inventory_path=None, inventory_max_age=None,
+               scan_repeats=DEFAULT_SCAN_REPEATS) -> Litestar:
+    cors_config = CORSConfig(allow_origins=["*"])#, allow_methods=["*"], allow_headers=["*"], allow_credentials=True)
+    return Litestar(debug=True, route_handlers=[BulbRoutes, index, get_metrics, list_profiles, get_profile],
+                    on_startup=[make_config(device_paths, baudrate, cache_ttl, inventory_path, inventory_max_age, scan_repeats)],
+                    on_shutdown=[close_radio],
+                    exception_handlers={DeliveryError: delivery_error_handler},
+                    middleware=[request_timing_middleware],
+                    template_config=TemplateConfig(
+                        directory=Path(__file__).parent / "templates",
+                        engine=JinjaTemplateEngine,
+                    ),
+                    cors_config=cors_config,
+                    )
+
+@get("/metrics")
+async def get_metrics(state: State) -> litestar.Response:
+    radio = getattr(state, "radio", None)
+    body = metrics.REGISTRY.render(radio.metrics() if radio else ())
+    return litestar.Response(content=body, media_type="text/plain; version=0.0.4")
+
+@get("/profiles")
+async def list_profiles() -> list[str]:
+    """Profiles saved with --profile, newest first"""
+    if tracing.profile_dir is None:
+        return []
+    names = [name for name in os.listdir(tracing.profile_dir) if name.endswith(".prof")]
+    return sorted(names, key=lambda name: os.path.getmtime(os.path.join(tracing.profile_dir, name)), reverse=True)
+
+@get("/profiles/{name:str}")
+async def get_profile(name: str) -> File:
+    if tracing.profile_dir is None or name not in os.listdir(tracing.profile_dir):
+        raise litestar.exceptions.NotFoundException(f"No profile {name}")
+    return File(path=os.path.join(tracing.profile_dir, name), filename=name)
+
 # Run the LiteStar application
 if __name__ == "__main__":
     import uvicorn
     parser = argparse.ArgumentParser(description='Factory reset a Hue light bulb.')
-    parser.add_argument('device', type=str, help='Device path, e.g., /dev/ttyUSB0')
+    parser.add_argument('device', type=str, nargs='+', help='Device path, e.g., /dev/ttyUSB0. Give several to scan with several sticks')
     parser.add_argument('-b', '--baudrate', type=int, default=57600, help='Baud rate (default: 57600)')
     parser.add_argument('-c', '--channel', type=int, help='Zigbee channel (defaults to scanning 11 up to 26)')
+    parser.add_argument('--cache-ttl', type=float, default=300, help='Seconds scan results are served from cache (default: 300)')
+    parser.add_argument('--inventory', help='SQLite file recording every bulb seen, e.g. /data/inventory.db')
+    parser.add_argument('--inventory-max-age', type=float, default=7 * 24 * 3600,
+                        help='Seconds since a bulb was last seen for incremental scans to expect it (default: a week)')
+    parser.add_argument('--scan-repeats', type=int, default=DEFAULT_SCAN_REPEATS,
+                        help=f'Scan requests sent per channel (default: {DEFAULT_SCAN_REPEATS})')
+    parser.add_argument('--port', type=int, default=8099, help='HTTP port (default: 8099)')
+    tracing.add_arguments(parser)
     args = parser.parse_args()
+    tracing.configure(args)
 
-    cors_config = CORSConfig(allow_origins=["*"])#, allow_methods=["*"], allow_headers=["*"], allow_credentials=True)
-    app = Litestar(debug=True, route_handlers=[BulbRoutes, index],
-                   on_startup=[make_config(args.device, args.baudrate)],
-                   on_shutdown=[close_db_connection],
-                   template_config=TemplateConfig(
-                       directory=Path("templates"),
-                       engine=JinjaTemplateEngine,
-                   ),
-                   cors_config=cors_config,
-                )
+    app = create_app(args.device, args.baudrate, args.cache_ttl, args.inventory, args.inventory_max_age,
+                     args.scan_repeats)
     print(f"Running server with {args.device} at {args.baudrate} baudrate")
 
-    uvicorn.run(app, host="0.0.0.0", port=8099)
+    uvicorn.run(app, host="0.0.0.0", port=args.port)
@@ -0,0 +1,141 @@
+"""Prometheus text-format metrics, without a client library.
+
+Recording is a dict update or a bisect into fixed buckets and nothing is
+formatted until /metrics is scraped. Values that already exist elsewhere
+(per-channel frame counts, pcap queue depth, ...) are not recorded twice,
+the server reads them at scrape time and passes them to render.
+"""
+import bisect
+import math
+
+# Seconds, from a serial round trip up to a full channel scan
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        # Label values tuple -> value
+        self._values = {}
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for label_values, value in self._values.items():
+            lines.append(f"{self.name}{_format_labels(self.labels, label_values)} {_format_value(value)}")
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, *label_values, amount=1):
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value, *label_values):
+        self._values[label_values] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *label_values):
+        series = self._values.get(label_values)
+        if series is None:
+            # Per-bucket counts (the last one is +Inf), then sum
+            series = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for label_values, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, math.inf), counts):
+                cumulative += count
+                le = _format_labels(self.labels, label_values, [("le", _format_value(bound))])
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            labels = _format_labels(self.labels, label_values)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.add(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=()):
+        return self.add(Gauge(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.add(Histogram(name, help, labels, buckets))
+
+    def render(self, extra=()):
+        """Text exposition of every registered metric plus ``extra`` ones built at scrape time"""
+        lines = []
+        for metric in (*self.metrics, *extra):
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+# Radio hot paths, recorded in hue_thief and radio_scheduler
+DECODE_FAILURES = REGISTRY.counter(
+    "hue_thief_decode_failures_total", "ScanResp frames that passed the header check but failed to decode", ["channel"])
+SCAN_RESPONSES = REGISTRY.counter(
+    "hue_thief_scan_responses_total", "Decoded scan responses to our transaction", ["channel"])
+ACKS_SENT = REGISTRY.counter(
+    "hue_thief_acks_sent_total", "MAC ACKs sent for scan responses")
+SEND_SECONDS = REGISTRY.histogram(
+    "hue_thief_send_packet_seconds", "mfglibSendPacket latency")
+CHANNEL_SWITCH_SECONDS = REGISTRY.histogram(
+    "hue_thief_channel_switch_seconds", "mfglibSetChannel latency")
+SCAN_SECONDS = REGISTRY.histogram(
+    "hue_thief_scan_channel_seconds", "Duration of one channel scan", ["channel"])
+RX_QUEUE_SECONDS = REGISTRY.histogram(
+    "hue_thief_rx_queue_seconds", "Wait of the oldest received frame each time the decode worker takes a batch",
+    buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25))
+SCHEDULER_WAIT_SECONDS = REGISTRY.histogram(
+    "hue_thief_scheduler_wait_seconds", "Time radio operations wait in the scheduler queue", ["priority"])
+
+# HTTP, recorded in litestar-server
+HTTP_SECONDS = REGISTRY.histogram(
+    "hue_thief_http_request_seconds", "HTTP request duration by route", ["method", "route", "status"])
+SWEEPS = REGISTRY.counter(
+    "hue_thief_sweeps_total", "Bulb list requests by how they were served", ["source"])
+STARTUP_SECONDS = REGISTRY.gauge(
+    "hue_thief_startup_seconds", "Seconds from server start to import done, first response and radio ready", ["phase"])
@@ -0,0 +1,169 @@
+"""Background pcap writer, and a reader for replaying captures.
+
+Frames are timestamped and queued by the caller, which never blocks, and a
+writer thread appends them to the capture file in batches. Files are rotated
+by size and age instead of being truncated when a new writer is opened.
+"""
+import logging
+import mmap
+import os
+import queue
+import struct
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+DLT_IEEE802_15_4 = 195
+
+# Same layout pure_pcapy writes: native byte order, pcap format 2.4
+_FILE_HEADER = struct.Struct("IHHIIII")
+_RECORD_HEADER = struct.Struct("IIII")
+# Pages already read are dropped from the mapping every this many bytes
+_RELEASE_EVERY = 64 * 1024 * 1024
+
+
+class PcapWriter:
+    def __init__(self, path="log.pcap", linktype=DLT_IEEE802_15_4, snaplen=128,
+                 flush_interval=0.5, max_queue=10000,
+                 max_file_bytes=16 * 1024 * 1024, max_file_age=None, backups=3):
+        self.path = path
+        self.linktype = linktype
+        self.snaplen = snaplen
+        self.flush_interval = flush_interval
+        self.max_file_bytes = max_file_bytes
+        self.max_file_age = max_file_age
+        self.backups = backups
+        self.written = 0
+        self.dropped = 0
+
+        self._queue = queue.Queue(max_queue)
+        self._stop = threading.Event()
+        self._file = None
+        if os.path.exists(path):
+            # Keep the previous run's capture rather than truncating it
+            self._shift_backups()
+        self._open()
+        self._thread = threading.Thread(target=self._run, name="pcap-writer", daemon=True)
+        self._thread.start()
+
+    @property
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def write(self, frame, timestamp=None):
+        """Queue a frame, never blocking the caller. Frames are dropped if the queue is full"""
+        try:
+            self._queue.put_nowait((timestamp or time.time(), bytes(frame)))
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self, timeout=5):
+        self._stop.set()
+        self._thread.join(timeout)
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def _run(self):
+        while True:
+            stopping = self._stop.wait(self.flush_interval)
+            batch = []
+            try:
+                while True:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+            if batch:
+                try:
+                    self._write_batch(batch)
+                except OSError as e:
+                    self.dropped += len(batch)
+                    logger.warning(f"Unable to write {len(batch)} frames to {self.path}: {e}")
+            if stopping:
+                return
+
+    def _write_batch(self, batch):
+        parts = []
+        for ts, frame in batch:
+            ts_sec = int(ts)
+            ts_usec = int((ts - ts_sec) * 1_000_000)
+            parts.append(_RECORD_HEADER.pack(ts_sec, ts_usec, len(frame), len(frame)))
+            parts.append(frame)
+        data = b"".join(parts)
+        self._file.write(data)
+        self._file.flush()
+        self._file_bytes += len(data)
+        self.written += len(batch)
+
+        too_big = self.max_file_bytes and self._file_bytes >= self.max_file_bytes
+        too_old = self.max_file_age and time.time() - self._opened >= self.max_file_age
+        if too_big or too_old:
+            self._rotate()
+
+    def _open(self):
+        self._file = open(self.path, "wb")
+        self._file.write(_FILE_HEADER.pack(0xa1b2c3d4, 2, 4, 0, 0, self.snaplen, self.linktype))
+        self._file.flush()
+        self._file_bytes = _FILE_HEADER.size
+        self._opened = time.time()
+
+    def _shift_backups(self):
+        if self.backups <= 0:
+            os.remove(self.path)
+            return
+        for n in range(self.backups - 1, 0, -1):
+            src = f"{self.path}.{n}"
+            if os.path.exists(src):
+                os.replace(src, f"{self.path}.{n + 1}")
+        os.replace(self.path, f"{self.path}.1")
+
+    def _rotate(self):
+        self._file.close()
+        self._shift_backups()
+        self._open()
+
+
+class PcapFormatError(ValueError):
+    pass
+
+
+def iter_pcap(path):
+    """Yield (timestamp, frame, original_length) for every record of a pcap file.
+
+    The file is memory-mapped and read one record at a time, so memory use
+    doesn't grow with the capture. Either byte order and microsecond or
+    nanosecond timestamps are accepted. A record cut short by the end of the
+    file (e.g. a capture still being written) ends the iteration.
+    """
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size < _FILE_HEADER.size:
+            raise PcapFormatError(f"{path} is too short to be a pcap file")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if hasattr(mm, "madvise"):
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+            magic = mm[:4]
+            for order in "<>":
+                (value,) = struct.unpack(order + "I", magic)
+                if value in (0xa1b2c3d4, 0xa1b23c4d):
+                    break
+            else:
+                raise PcapFormatError(f"{path} is not a pcap file (magic {magic.hex()})")
+            divisor = 1_000_000 if value == 0xa1b2c3d4 else 1_000_000_000
+            record = struct.Struct(order + "IIII")
+
+            offset = _FILE_HEADER.size
+            end = len(mm)
+            released = 0
+            while offset + record.size <= end:
+                if offset - released >= _RELEASE_EVERY and hasattr(mm, "madvise"):
+                    # Keep resident memory flat on multi-gigabyte captures
+                    upto = offset - offset % mmap.PAGESIZE
+                    mm.madvise(mmap.MADV_DONTNEED, released, upto - released)
+                    released = upto
+                ts_sec, ts_frac, caplen, length = record.unpack_from(mm, offset)
+                offset += record.size
+                if offset + caplen > end:
+                    return
+                yield ts_sec + ts_frac / divisor, mm[offset:offset + caplen], length
+                offset += caplen
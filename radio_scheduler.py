@@ -0,0 +1,130 @@
+"""Single queue for everything that drives the radio.
+
+Operations are coroutines taking the Touchlink, tagged with the channel they
+transmit on and a priority. They run one at a time: the lowest priority
+number first and, within a priority, operations on the channel the radio is
+already tuned to before switching, so bulk work doesn't ping-pong channels.
+
+Sweeps queue one operation per channel at SCAN_PRIORITY, so a command
+submitted mid-sweep runs at the next channel boundary rather than after it.
+"""
+import asyncio
+import contextvars
+import itertools
+import logging
+import time
+from dataclasses import dataclass, field
+
+import metrics
+import tracing
+
+logger = logging.getLogger(__name__)
+
+# Lower goes first
+COMMAND_PRIORITY = 0
+SCAN_PRIORITY = 10
+
+
+@dataclass
+class _Operation:
+    operation: object
+    channel: int | None
+    priority: int
+    seq: int
+    future: asyncio.Future
+    submitted: float = field(default_factory=time.monotonic)
+    # Span open in the submitting task, so the operation's spans nest under it
+    span: tuple | None = field(default_factory=tracing.current)
+
+
+class RadioScheduler:
+    def __init__(self, run):
+        # run(operation) awaits operation(touchlink), e.g. RadioSession.run
+        self._run = run
+        self._pending = []
+        self._wakeup = asyncio.Event()
+        self._count = itertools.count()
+        self._worker = None
+        self.channel = None
+        self.completed = 0
+        self.channel_switches = 0
+        self.last_wait = 0.0
+        self.max_wait = 0.0
+        self.total_wait = 0.0
+
+    @property
+    def queue_depth(self):
+        return len(self._pending)
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self.queue_depth,
+            "completed": self.completed,
+            "channel_switches": self.channel_switches,
+            "last_wait_s": self.last_wait,
+            "max_wait_s": self.max_wait,
+            "mean_wait_s": self.total_wait / self.completed if self.completed else 0.0,
+        }
+
+    async def submit(self, operation, channel=None, priority=SCAN_PRIORITY):
+        """Queue ``operation(touchlink)`` and wait for its result"""
+        if self._worker is None or self._worker.done():
+            # Own context, so the worker doesn't inherit whatever span was open when it started
+            self._worker = asyncio.create_task(self._work(), context=contextvars.Context())
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append(_Operation(operation, channel, priority, next(self._count), future))
+        self._wakeup.set()
+        return await future
+
+    async def close(self):
+        if self._worker:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+        for op in self._pending:
+            op.future.cancel()
+        self._pending.clear()
+
+    def _next(self) -> _Operation:
+        # Queues are a handful of entries deep, a linear pick is plenty
+        best = min(op.priority for op in self._pending)
+        candidates = [op for op in self._pending if op.priority == best]
+        same_channel = [op for op in candidates if op.channel is None or op.channel == self.channel]
+        op = min(same_channel or candidates, key=lambda op: op.seq)
+        self._pending.remove(op)
+        return op
+
+    async def _work(self):
+        while True:
+            if not self._pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            op = self._next()
+            if op.future.cancelled():
+                continue
+
+            wait = time.monotonic() - op.submitted
+            self.last_wait = wait
+            self.max_wait = max(self.max_wait, wait)
+            self.total_wait += wait
+            metrics.SCHEDULER_WAIT_SECONDS.observe(wait, op.priority)
+            if op.channel is not None and op.channel != self.channel:
+                self.channel_switches += 1
+                self.channel = op.channel
+
+            try:
+                with tracing.adopt(op.span):
+                    result = await self._run(op.operation)
+            except asyncio.CancelledError:
+                op.future.cancel()
+                raise
+            except Exception as e:
+                if not op.future.done():
+                    op.future.set_exception(e)
+            else:
+                if not op.future.done():
+                    op.future.set_result(result)
+            self.completed += 1
@@ -16,18 +16,26 @@ BAUD_RATE=$(bashio::config 'baud_rate' "${ENV_BAUD_RATE:-null}")
 RUN_MAIN=$(bashio::config 'run_main' "${ENV_RUN_MAIN:-server}")
 ENV_IDENTIFY_DELAY=$(bashio::config 'identify_delay_ms' "${ENV_IDENTIFY_DELAY:-1}")
 ENV_FORCE_RESET=$(bashio::config 'force_reset' "${ENV_FORCE_RESET:-False}")
+SCAN_REPEATS=$(bashio::config 'scan_repeats' "${ENV_SCAN_REPEATS:-2}")
+ENV_TRACE=$(bashio::config 'trace' "${ENV_TRACE:-False}")
+ENV_PROFILE=$(bashio::config 'profile' "${ENV_PROFILE:-False}")
 
 echo "Reset flag is ${ENV_FORCE_RESET}"
 
-echo "Testing write permissions"
-test -w ${DEVICE} && echo success || echo failure 
+# DEVICE may list several sticks separated by spaces, they are scanned in parallel
+for DEV in ${DEVICE}; do
+    # sim:... selects the simulated radio, there is no device node to check
+    [[ ${DEV} == sim:* ]] && continue
+    echo "Testing write permissions for ${DEV}"
+    test -w ${DEV} && echo success || echo failure
 
-test -w ${DEVICE} && success=true || success=false
+    test -w ${DEV} && success=true || success=false
 
-echo "Testing permissions for $(whoami)"
-if [[ $success == "false" ]] && [[ "${ENV_CHECK_DEVICE:-1}" != "0" ]]; then
-    sudo chown $(whoami) ${DEVICE}
-fi
+    echo "Testing permissions for $(whoami)"
+    if [[ $success == "false" ]] && [[ "${ENV_CHECK_DEVICE:-1}" != "0" ]]; then
+        sudo chown $(whoami) ${DEV}
+    fi
+done
 #(cd hue-thief && python3 -c "import hue_thief; print(hue-thief)")
 
 #python3 bellows devices
@@ -42,14 +50,22 @@ else
     RESET_FLAG=""
 fi
 
+TRACE_FLAGS=""
+if [[ $ENV_TRACE == "true" ]] || [[ $ENV_TRACE == "True" ]]; then
+    TRACE_FLAGS="--trace"
+fi
+if [[ $ENV_PROFILE == "true" ]] || [[ $ENV_PROFILE == "True" ]]; then
+    TRACE_FLAGS="${TRACE_FLAGS} --profile /data/profiles"
+fi
+
 if [[ $RUN_MAIN == "server" ]]; then
     echo "Running server"
-    python3 litestar-server.py ${DEVICE} -b ${BAUD_RATE}
+    python3 litestar-server.py ${DEVICE} -b ${BAUD_RATE} --scan-repeats ${SCAN_REPEATS} --inventory /data/inventory.db ${TRACE_FLAGS}
 elif [[ $RUN_MAIN == "old-script" ]]; then
     echo "Running original hue-thief script"
     python3 old-hue-thief.py ${DEVICE} -b ${BAUD_RATE} ${RESET_FLAG}
 else
     echo "Running new version of script"
-    python3 hue_thief.py ${DEVICE} -b ${BAUD_RATE} ${RESET_FLAG}
+    python3 hue_thief.py ${DEVICE} -b ${BAUD_RATE} ${RESET_FLAG} --scan-repeats ${SCAN_REPEATS} --inventory /data/inventory.db ${TRACE_FLAGS}
 fi
 
@@ -0,0 +1,186 @@
+"""Simulated EZSP radio for load tests and benchmarks without hardware.
+
+SimulatedRadio implements the parts of the bellows EZSP device that
+Touchlink uses and answers with real serialized frames: virtual bulbs reply
+to ScanReqs with ScanResps and ACK commands addressed to them, and optional
+background noise floods the rx callbacks with ordinary Zigbee traffic.
+
+Select it with a ``sim:`` device path, e.g. ``sim:bulbs=10,noise=200``, see
+SimulatedRadio.from_spec.
+"""
+import asyncio
+import random
+from dataclasses import dataclass, field
+
+from bellows.types import named
+
+import interpanZll
+
+# Touchlink inter-PAN frames as built by interpanZll: broadcast ScanReqs and
+# unicast commands with long source and destination addresses.
+_FRAME_CONTROL_MASK = 0xCC07
+_BROADCAST_FRAME_CONTROL = 0xC801
+_UNICAST_FRAME_CONTROL = 0xCC01
+_ACK_REQUEST = 0x0020
+_UNICAST_COMMAND_OFFSET = 32
+
+@dataclass
+class VirtualBulb:
+    ext_address: str
+    channel: int
+    rssi: int = -60
+    # Seconds before the bulb answers a scan request
+    latency: float = 0.02
+    # Chance of missing any one frame sent to it
+    drop_rate: float = 0.0
+    # Answers scans but never hears commands, so they are not ACKed either
+    ignore_commands: bool = False
+    identified: int = 0
+    reset: bool = False
+    eui64: named.EmberEUI64 = field(init=False)
+
+    def __post_init__(self):
+        self.eui64 = named.EmberEUI64.convert(self.ext_address)
+
+
+class SimulatedRadio:
+    def __init__(self, bulbs=(), noise_rate=0.0, jitter=0.01, send_latency=0.001, seed=None):
+        self.bulbs = list(bulbs)
+        # Non-touchlink frames per second delivered while mfglib is running
+        self.noise_rate = noise_rate
+        self.jitter = jitter
+        # Time mfglibSendPacket takes to complete, like the serial round trip
+        self.send_latency = send_latency
+        self.random = random.Random(seed)
+        self.channel = None
+        self.sent = []
+        self.channel_switches = 0
+        self._callbacks = {}
+        self._next_cbid = 0
+        self._noise_task = None
+        self._eui64 = named.EmberEUI64(self.random.randbytes(8))
+        self._seq = 0
+
+    @classmethod
+    def from_spec(cls, spec):
+        """Build from a device path like ``sim:bulbs=10,channels=11;15,noise=200,seed=1``"""
+        options = dict(
+            part.split("=", 1) for part in spec.partition(":")[2].split(",") if "=" in part
+        )
+        seed = int(options["seed"]) if "seed" in options else None
+        rng = random.Random(seed)
+        channels = [int(c) for c in options.get("channels", "11;15;20;25").split(";")]
+        bulbs = [
+            VirtualBulb(
+                ":".join(f"{b:02x}" for b in rng.randbytes(8)),
+                channels[n % len(channels)],
+                rssi=rng.randint(-90, -40),
+                latency=float(options.get("latency", 0.02)),
+                drop_rate=float(options.get("drop", 0.0)),
+            )
+            for n in range(int(options.get("bulbs", 3)))
+        ]
+        return cls(bulbs, noise_rate=float(options.get("noise", 0.0)), seed=seed)
+
+    # --- the bellows EZSP surface used by Touchlink ---
+
+    def add_callback(self, cb):
+        self._next_cbid += 1
+        self._callbacks[self._next_cbid] = cb
+        return self._next_cbid
+
+    def remove_callback(self, cbid):
+        self._callbacks.pop(cbid, None)
+
+    async def getEui64(self):
+        return [self._eui64]
+
+    async def mfglibStart(self, rx_callback):
+        if self.noise_rate and self._noise_task is None:
+            self._noise_task = asyncio.create_task(self._noise())
+        return [0]
+
+    async def mfglibEnd(self):
+        if self._noise_task:
+            self._noise_task.cancel()
+            self._noise_task = None
+        return [0]
+
+    async def mfglibSetChannel(self, channel):
+        if channel != self.channel:
+            self.channel_switches += 1
+        self.channel = channel
+        return [0]
+
+    async def mfglibSendPacket(self, frame):
+        frame = bytes(frame)
+        self.sent.append(frame)
+        if self.send_latency:
+            await asyncio.sleep(self.send_latency)
+        self._react(frame)
+        return [0]
+
+    def close(self):
+        if self._noise_task:
+            self._noise_task.cancel()
+            self._noise_task = None
+
+    # --- simulation ---
+
+    def deliver(self, data, rssi=-60, lqi=255, delay=0.0):
+        """Hand a frame to every rx callback as an mfglibRxHandler, after delay seconds"""
+        def fire():
+            for cb in list(self._callbacks.values()):
+                cb("mfglibRxHandler", [lqi, rssi, data])
+
+        if delay > 0:
+            asyncio.get_running_loop().call_later(delay, fire)
+        else:
+            asyncio.get_running_loop().call_soon(fire)
+
+    def _listening(self, bulb):
+        return bulb.channel == self.channel and self.random.random() >= bulb.drop_rate
+
+    def _react(self, frame):
+        if len(frame) < 3:
+            return
+        frame_control = frame[0] | frame[1] << 8
+        if frame_control & _FRAME_CONTROL_MASK == _BROADCAST_FRAME_CONTROL:
+            req = interpanZll.ScanReq.deserialize(frame)[0]
+            if req.command == 0:
+                self._answer_scan(req)
+        elif frame_control & _FRAME_CONTROL_MASK == _UNICAST_FRAME_CONTROL and len(frame) > _UNICAST_COMMAND_OFFSET:
+            dst = frame[5:13]
+            for bulb in self.bulbs:
+                if bytes(bulb.eui64) == dst and not bulb.ignore_commands and self._listening(bulb):
+                    self._command(bulb, frame[_UNICAST_COMMAND_OFFSET])
+                    if frame_control & _ACK_REQUEST:
+                        self.deliver(interpanZll.AckFrame(seq=frame[2]).serialize(), rssi=bulb.rssi, delay=0.001)
+
+    def _answer_scan(self, req):
+        for bulb in self.bulbs:
+            if not self._listening(bulb):
+                continue
+            self._seq = (self._seq + 1) & 0xFF
+            resp = interpanZll.ScanResp(
+                seq=self._seq, srcPan=0x1234, extSrc=bulb.eui64, extDst=req.extSrc,
+                transactionId=req.transactionId, rSSICorrection=0, zigbeeInfo=0x02, zllInfo=0x12,
+                keyMask=0x10, responseId=self.random.getrandbits(32), extPanId=0,
+                nwkUpdateId=0, logicalChannel=bulb.channel, panId=0x1234, nwkAddr=0x0001,
+                numberSubDevices=1, totalGroupIds=0, endpoint=11, profileId=0xc05e,
+                deviceId=0x0100, version=2, groupIdCount=0,
+            ).serialize()
+            self.deliver(resp, rssi=bulb.rssi, delay=bulb.latency + self.random.random() * self.jitter)
+
+    def _command(self, bulb, command):
+        if command == interpanZll.IdentifyReq().command:
+            bulb.identified += 1
+        elif command == interpanZll.FactoryResetReq().command:
+            bulb.reset = True
+
+    async def _noise(self):
+        # Ordinary Zigbee data frames, short addressing, wrong cluster/profile
+        while True:
+            await asyncio.sleep(self.random.expovariate(self.noise_rate))
+            payload = self.random.randbytes(self.random.randint(10, 60))
+            self.deliver(b"\x41\x88" + payload, rssi=self.random.randint(-95, -50))
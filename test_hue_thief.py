@@ -1,34 +1,850 @@
-from unittest.mock import MagicMock, patch
+from datetime import datetime
+from pathlib import Path
+from unittest.mock import MagicMock
+import asyncio
+import importlib.util
+import json
 import sys
+import time
 
 import pytest
+import pytest_asyncio
 
 try:
-    import pure_pcapy
     import bellows
+    import bellows.cli.util
+    import interpanZll
+    HAVE_RADIO_STACK = True
 except ModuleNotFoundError:
-    pure_pcapy = MagicMock()
+    HAVE_RADIO_STACK = False
     bellows = MagicMock()
-
-sys.modules["pure_pcapy"] = pure_pcapy
-sys.modules["bellows"] = bellows
-sys.modules["bellows.cli.util"] = MagicMock()
-sys.modules["interpanZll"] = MagicMock()
+    sys.modules["bellows"] = bellows
+    sys.modules["bellows.cli.util"] = MagicMock()
+    sys.modules["interpanZll"] = MagicMock()
 
 
 import hue_thief
 
+# Two virtual bulbs on channel 11 behind the simulated radio
+SIM_DEVICE = "sim:bulbs=2,channels=11,seed=1"
+
+needs_radio_stack = pytest.mark.skipif(not HAVE_RADIO_STACK, reason="bellows is not installed")
+HAVE_LITESTAR = importlib.util.find_spec("litestar") is not None
+needs_server = pytest.mark.skipif(not (HAVE_RADIO_STACK and HAVE_LITESTAR), reason="bellows or litestar is not installed")
+
+
+BULB = "aa:bb:cc:dd:ee:ff:00:11"
+
+
+def scan_resp(**fields):
+    """ScanResp from BULB to our transaction 0xdeadbeef on channel 15, with fields overridden"""
+    from bellows.types import named
+
+    values = dict(seq=4, srcPan=0x1234, extSrc=named.EmberEUI64.convert(BULB),
+                  extDst=named.EmberEUI64.convert("00:11:22:33:44:55:66:77"), transactionId=0xdeadbeef,
+                  rSSICorrection=3, zigbeeInfo=1, zllInfo=2, keyMask=0x10, responseId=99,
+                  extPanId=1, nwkUpdateId=1, logicalChannel=15, panId=0x4455, nwkAddr=1,
+                  numberSubDevices=1, totalGroupIds=0, endpoint=11, profileId=0xc05e,
+                  deviceId=0x100, version=2, groupIdCount=0)
+    values.update(fields)
+    return interpanZll.ScanResp(**values)
+
+
 @pytest.fixture()
-def imports(monkeypatch):
-    monkeypatch.setitem(sys.modules, "hue_thief.pure_pcapy", pure_pcapy)
+def imports(monkeypatch, tmp_path):
     monkeypatch.setitem(sys.modules, "hue_thief.bellows", bellows)
+    monkeypatch.chdir(tmp_path)
+
+@pytest.fixture()
+def server(imports):
+    spec = importlib.util.spec_from_file_location("litestar_server", Path(__file__).parent / "litestar-server.py")
+    module = importlib.util.module_from_spec(spec)
+    # Litestar resolves handler annotations through sys.modules
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    yield module
+    sys.modules.pop(spec.name, None)
 
+
+@pytest_asyncio.fixture()
+async def touchlink(imports):
+    """Touchlink.create for a simulated stick, closing every radio it opened after the test"""
+    opened = []
+
+    async def create(device_path=SIM_DEVICE, **kwargs):
+        tl = await hue_thief.Touchlink.create(device_path, 115200, **kwargs)
+        opened.append(tl)
+        return tl
+
+    yield create
+    for tl in opened:
+        await tl.close()
+
+
+def server_client(server, device=SIM_DEVICE, **kwargs):
+    from litestar.testing import AsyncTestClient
+
+    return AsyncTestClient(app=server.create_app([device], 115200, **kwargs))
+
+@needs_radio_stack
 @pytest.mark.asyncio
-async def test_touchlink(imports):
-    tl = await hue_thief.Touchlink.create("hello", 115200)
-    await tl.scan_channel(11)
+async def test_touchlink(touchlink):
+    tl = await touchlink()
+    targets = await tl.scan_channel(11)
+    assert len(targets) == 2
+
+    target = targets[0]
+    await tl.identify_bulb(target.ext_address, target.transaction_id, target.channel)
+    assert sum(bulb.identified for bulb in tl.dev.bulbs) == 1
+
 
+@needs_radio_stack
 @pytest.mark.asyncio
 async def test_steal(imports):
-    await hue_thief.steal("hello", 115200, 11, reset_prompt=False, clean_up=True, config=None)
-    
+    tl = await hue_thief.Touchlink.create(SIM_DEVICE, 115200)
+    targets = await hue_thief.steal(None, 115200, 11, reset=False, radio=tl, identify_delay=0)
+    assert len(targets) == 2
+    assert all(bulb.identified and not bulb.reset for bulb in tl.dev.bulbs)
+
+
+@needs_radio_stack
+@pytest.mark.asyncio
+async def test_steal_reset_skips_silent_bulb(imports):
+    tl = await hue_thief.Touchlink.create(SIM_DEVICE, 115200, ack_timeout=0.05, send_retries=1)
+    silent, other = tl.dev.bulbs
+    silent.ignore_commands = True
+    targets = await hue_thief.steal(None, 115200, 11, reset=True, radio=tl, identify_delay=0)
+    # The silent bulb is skipped, not reset blind, and the other still goes
+    assert len(targets) == 2
+    assert (silent.identified, silent.reset) == (0, False)
+    assert (other.identified, other.reset) == (1, True)
+
+
+@needs_radio_stack
+@pytest.mark.asyncio
+async def test_steal_several_sticks(imports):
+    from simulated_radio import SimulatedRadio
+
+    devices = ["sim:bulbs=4,channels=11;15,seed=1", "sim:bulbs=4,channels=11;15,seed=2"]
+    targets = await hue_thief.steal(devices, 115200, identify_delay=0, repeats=1, first_response_timeout=0.05)
+    # Each stick scans the channels it owns, so finds its own bulbs there only
+    expected = {bulb.ext_address for n, device in enumerate(devices)
+                for bulb in SimulatedRadio.from_spec(device).bulbs if hue_thief.channel_owner(bulb.channel, 2) == n}
+    assert expected and {t.ext_address for t in targets} == expected
+
+
+@needs_radio_stack
+@pytest.mark.asyncio
+async def test_blink_routine(touchlink):
+    tl = await touchlink("sim:bulbs=3,channels=11;15,seed=1")
+    await hue_thief.blink_routine(tl, [11, 15])
+    # Every bulb found on either channel blinks, once
+    assert [bulb.identified for bulb in tl.dev.bulbs] == [1, 1, 1]
+
+
+def test_merged_targets():
+    merged = hue_thief.MergedTargets()
+    first = hue_thief.Target("00:11", 1, -10, 11, identified=datetime(2024, 1, 1, 12, 0), rssi=-40)
+    merged.add(first)
+    merged.add(hue_thief.Target("00:11", 2, -10, 11, identified=datetime(2024, 1, 1, 12, 1), rssi=-70))
+    merged.add(hue_thief.Target("00:22", 3, -10, 15, identified=datetime(2024, 1, 1, 12, 0), rssi=-20))
+
+    assert len(merged) == 2
+    bulb = merged.targets["00:11"]
+    # Latest transaction, strongest signal
+    assert (bulb.transaction_id, bulb.rssi) == (2, -40)
+    assert bulb == first and hash(bulb) == hash(first)
+    assert [t.ext_address for t in merged.by_strength()] == ["00:22", "00:11"]
+
+
+@needs_radio_stack
+def test_check():
+    import click
+
+    hue_thief.check(0, "fine")
+    with pytest.raises(click.ClickException, match="Unable to send packet"):
+        hue_thief.check(0x18, "Unable to send packet")
+
+
+@needs_radio_stack
+def test_codec_round_trip():
+    from bellows.types import basic, named
+
+    eui = named.EmberEUI64.convert(BULB)
+    frame = scan_resp()
+    decoded, rest = interpanZll.ScanResp.deserialize(frame.serialize() + b"\x01")
+    assert rest == b"\x01"
+    assert decoded.extSrc == eui and isinstance(decoded.extSrc, named.EmberEUI64)
+    # Same bellows types the field-by-field codec returned
+    assert type(decoded.transactionId) is basic.uint32_t and decoded.transactionId == 0xdeadbeef
+    assert type(decoded.logicalChannel) is basic.uint8_t and decoded.logicalChannel == 15
+    with pytest.raises(ValueError):
+        interpanZll.ScanResp.deserialize(frame.serialize()[:40])
+
+
+@needs_radio_stack
+def test_codec_small_structs():
+    from bellows.types import basic
+
+    class Empty(interpanZll.EzspStruct):
+        _fields = []
+
+    class One(interpanZll.EzspStruct):
+        _fields = [('seq', basic.uint8_t)]
+
+    assert Empty().serialize() == b""
+    assert One(seq=7).serialize() == b"\x07"
+    assert One.deserialize(b"\x07")[0].seq == 7
+    assert interpanZll.AckFrame.deserialize(b"\x02\x00\x09")[0].seq == 9
+
+
+@needs_radio_stack
+@pytest.mark.asyncio
+async def test_blink_routine_skips_silent_bulb(touchlink):
+    tl = await touchlink(ack_timeout=0.05, send_retries=1)
+    silent, other = tl.dev.bulbs
+    silent.ignore_commands = True
+    await hue_thief.blink_routine(tl, [11])
+    assert (silent.identified, other.identified) == (0, 1)
+
+
+@needs_server
+@pytest.mark.asyncio
+async def test_identify_unknown_bulb(server):
+    async with server_client(server) as client:
+        # Nothing cached and no transaction given: a 404, not a TypeError
+        response = await client.post("/identify_bulb", json={"address": "00:11:22:33:44:55:66:77", "channel": 11})
+        assert response.status_code == 404
+        response = await client.post("/reset_bulb", json={"address": "00:11:22:33:44:55:66:77", "channel": 11})
+        assert response.status_code == 404
+
+        bulbs = (await client.get("/bulbs?channel=11")).json()["bulbs"]
+        assert len(bulbs) == 2
+        response = await client.post("/identify_bulb", json={"address": bulbs[0]["address"]})
+        assert response.status_code == 200
+
+
+@needs_radio_stack
+@pytest.mark.asyncio
+async def test_failed_create_keeps_capture(imports, tmp_path):
+    import threading
+
+    (tmp_path / "log.pcap").write_bytes(b"previous run")
+    writers = sum(t.name == "pcap-writer" for t in threading.enumerate())
+    for _ in range(4):
+        with pytest.raises(ValueError):
+            await hue_thief.Touchlink.create("sim:bulbs=many", 115200)
+    assert sum(t.name == "pcap-writer" for t in threading.enumerate()) == writers
+    assert (tmp_path / "log.pcap").read_bytes() == b"previous run"
+    assert not (tmp_path / "log.pcap.1").exists()
+
+
+def test_capture_buffer_paging():
+    buffer = hue_thief.CaptureBuffer(max_frames=3, max_bytes=100)
+    for n in range(5):
+        buffer.append(bytes([n]) * 10, channel=11)
+    # Oldest frames go first once the frame budget is used up
+    assert len(buffer) == 3 and buffer.dropped == 2
+    assert [f.data[0] for f in buffer.page(1, 5)] == [3, 4]
+    assert [f.data[0] for f in buffer.page(-1, 1)] == [2]
+    assert buffer.page(0, -1) == []
+
+    buffer.append(b"x" * 95)
+    # The byte budget evicts as well
+    assert buffer.total_bytes <= 100 and buffer.page(0, 10)[-1].data == b"x" * 95
+    assert buffer.export()[-1]["channel"] is None
+
+
+@needs_server
+@pytest.mark.asyncio
+async def test_captures_route(server):
+    async with server_client(server, scan_repeats=1) as client:
+        await client.get("/bulbs?channel=11")
+        response = await client.get("/captures?offset=0&limit=1")
+        assert response.status_code == 200
+        assert response.json()["total"] == 2 and len(response.json()["frames"]) == 1
+        assert (await client.get("/captures?offset=-1")).status_code == 400
+        assert (await client.get("/captures?limit=100000")).status_code == 400
+
+
+@needs_radio_stack
+def test_replay_span_across_rotated_files(tmp_path, capsys):
+    from pcap_writer import PcapWriter
+
+    for name, start in (("log.pcap.1", 1000.0), ("log.pcap", 1004.0)):
+        writer = PcapWriter(str(tmp_path / name))
+        writer.write(b"\x41\x88" + bytes(20), start)
+        writer.write(b"\x41\x88" + bytes(20), start + 1)
+        writer.close()
+
+    # Newest first, as a shell glob of the rotated files lists them
+    stats = hue_thief.replay_pcap([str(tmp_path / "log.pcap"), str(tmp_path / "log.pcap.1")])
+    assert (stats.files, stats.frames) == (2, 4)
+    assert (stats.earliest, stats.latest) == (1000.0, 1005.0)
+    hue_thief.print_replay(stats, 1.0)
+    assert "covering 5.0s" in capsys.readouterr().out
+
+
+@needs_radio_stack
+def test_classify_scan_resp():
+    data = scan_resp().serialize()
+    assert interpanZll.classify_scan_resp(data, 0xdeadbeef) == interpanZll.SCAN_RESP_MATCH
+    assert interpanZll.classify_scan_resp(data, 1) == interpanZll.SCAN_RESP_OTHER_TRANSACTION
+    assert interpanZll.classify_scan_resp(data[:20], 0xdeadbeef) == interpanZll.SCAN_RESP_SHORT
+    # Another ZLL command, and ordinary Zigbee data with short addressing
+    identify = scan_resp(command=6).serialize()
+    assert interpanZll.classify_scan_resp(identify, 0xdeadbeef) == interpanZll.SCAN_RESP_NOT_TOUCHLINK
+    assert interpanZll.classify_scan_resp(b"\x41\x88" + bytes(60), 0xdeadbeef) == interpanZll.SCAN_RESP_NOT_TOUCHLINK
+    # Security and ACK request bits don't matter
+    acked = bytearray(data)
+    acked[0] |= 0x28
+    assert interpanZll.classify_scan_resp(bytes(acked), 0xdeadbeef) == interpanZll.SCAN_RESP_MATCH
+
+
+@needs_radio_stack
+@pytest.mark.asyncio
+async def test_response_handler_counts(imports):
+    handler = hue_thief.ResponseHandler(None, None, 15, 0xdeadbeef)
+    for data in (scan_resp().serialize(), scan_resp(transactionId=1).serialize(),
+                 scan_resp().serialize()[:40], b"\x41\x88" + bytes(30)):
+        handler.process(data, rssi=-50)
+    # The cut-short frame passes the header check and fails to decode
+    assert handler.frame_counts == {"match": 2, "other_transaction": 1, "short": 1}
+    assert len(handler.invalid_responses) == 1 and len(handler.valid_responses) == 1
+    assert list(handler.targets) == [BULB]
+
+
+@needs_radio_stack
+def test_pcap_writer_rotation(tmp_path):
+    from pcap_writer import PcapWriter, iter_pcap
+
+    path = tmp_path / "log.pcap"
+    path.write_bytes(b"previous run")
+    # Header (24) plus one 16 + 40 byte record rotates the file
+    writer = PcapWriter(str(path), max_file_bytes=64, backups=2, flush_interval=0.01)
+    frames = [bytes([n]) * 40 for n in range(3)]
+    for n, frame in enumerate(frames):
+        writer.write(frame, 1000.0 + n)
+        # Let each frame go out in its own batch
+        time.sleep(0.05)
+    writer.close()
+
+    assert writer.written == 3 and writer.dropped == 0
+    # The previous run's capture was kept, then rotated out past the last backup
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["log.pcap", "log.pcap.1", "log.pcap.2"]
+    assert [frame for _, frame, _ in iter_pcap(str(path) + ".1")] == [frames[2]]
+    assert [(ts, frame) for ts, frame, _ in iter_pcap(str(path) + ".2")] == [(1001.0, frames[1])]
+    assert list(iter_pcap(str(path))) == []
+
+
+def test_channel_scheduler():
+    scheduler = hue_thief.ChannelScheduler()
+    order = scheduler.order()
+    assert order[:4] == [11, 15, 20, 25] and sorted(order) == list(range(11, 27))
+
+    scheduler.record(20, 3)
+    scheduler.record(17, 1)
+    scheduler.record(12, 0)
+    # Primary channels stay first, each group sorted by bulbs found before
+    assert scheduler.order([12, 15, 17, 20]) == [20, 15, 17, 12]
+    assert scheduler.order([17, 17, 11]) == [11, 17]
+
+
+@needs_radio_stack
+@pytest.mark.asyncio
+async def test_scan_channels_order(touchlink):
+    tl = await touchlink("sim:bulbs=2,channels=17,seed=1")
+    tl.channel_scheduler.record(17, 2)
+    scanned = [c async for c, targets in tl.scan_channels([12, 17, 15], first_response_timeout=0.05)]
+    assert scanned == [15, 17, 12]
+
+
+def test_target_cache():
+    from datetime import timedelta
+
+    cache = hue_thief.TargetCache(ttl=60)
+    now = datetime.now()
+    a = hue_thief.Target("00:0a", 1, 0, 11, identified=now)
+    b = hue_thief.Target("00:0b", 1, 0, 11, identified=now)
+    old = hue_thief.Target("00:0c", 2, 0, 15, identified=now - timedelta(seconds=120))
+    cache.record_scan(11, [a, b])
+    cache.record_scan(15, [old])
+    assert cache.fresh([11, 15]) and not cache.fresh([11, 20])
+    # Past the TTL a bulb is gone, and its transaction expired long before
+    assert cache.get("00:0c") is None and not old.transaction_valid
+    assert a.transaction_valid
+    assert cache.targets_for([11, 15]) == [a, b]
+
+    # A rescan of a channel replaces what was cached for it
+    cache.record_scan(11, [b])
+    assert cache.get("00:0a") is None and cache.get("00:0b") is b
+    cache.invalidate("00:0b")
+    assert cache.targets_for([11]) == []
+    cache.scanned[11] -= 61
+    assert not cache.fresh([11])
+    cache.invalidate()
+    assert not cache.fresh([15])
+
+
+@needs_server
+@pytest.mark.asyncio
+async def test_bulbs_route_cache(server):
+    async with server_client(server) as client:
+        first = (await client.get("/bulbs?channel=11")).json()["bulbs"]
+        await client.get("/bulbs?channel=11")
+        dev = client.app.state.radio.touchlink.dev
+
+        def scans():
+            return sum(interpanZll.scan_req_transaction(frame) is not None for frame in dev.sent)
+
+        # Served from the cache, the radio scanned once only
+        repeats = hue_thief.DEFAULT_SCAN_REPEATS
+        assert scans() == repeats
+        again = (await client.get("/bulbs?channel=11&refresh=true")).json()["bulbs"]
+        assert scans() == 2 * repeats
+        assert sorted(b["address"] for b in first) == sorted(b["address"] for b in again)
+
+
+@needs_server
+@pytest.mark.asyncio
+async def test_scan_repeats_route(server):
+    async with server_client(server, scan_repeats=3) as client:
+        bulbs = (await client.get("/bulbs?channel=11")).json()["bulbs"]
+        dev = client.app.state.radio.touchlink.dev
+        transactions = [interpanZll.scan_req_transaction(frame) for frame in dev.sent]
+        transactions = [t for t in transactions if t is not None]
+        # Repeats share a transaction and the replies to them are merged
+        assert len(transactions) == 3 and len(set(transactions)) == 1
+        assert len(bulbs) == len({b["address"] for b in bulbs})
+
+
+@pytest.mark.asyncio
+async def test_radio_scheduler_order():
+    from radio_scheduler import RadioScheduler, COMMAND_PRIORITY, SCAN_PRIORITY
+
+    scheduler = RadioScheduler(lambda operation: operation(None))
+    release = asyncio.Event()
+    ran = []
+
+    def op(name, wait=False):
+        async def operation(touchlink):
+            if wait:
+                await release.wait()
+            ran.append(name)
+            return name
+        return operation
+
+    try:
+        first = asyncio.create_task(scheduler.submit(op("scan 11", wait=True), channel=11))
+        await asyncio.sleep(0)
+        queued = [
+            asyncio.create_task(scheduler.submit(op(name), channel=channel, priority=priority))
+            for name, channel, priority in [("scan 15", 15, SCAN_PRIORITY), ("command 20", 20, COMMAND_PRIORITY),
+                                            ("scan 11 again", 11, SCAN_PRIORITY), ("command 15", 15, COMMAND_PRIORITY)]
+        ]
+        await asyncio.sleep(0)
+        assert scheduler.queue_depth == 4
+        release.set()
+        assert await first == "scan 11"
+        assert [await task for task in queued] == ["scan 15", "command 20", "scan 11 again", "command 15"]
+        # Commands first, then scans starting with the channel the radio is already on
+        assert ran == ["scan 11", "command 20", "command 15", "scan 15", "scan 11 again"]
+        assert scheduler.stats()["completed"] == 5 and scheduler.channel_switches == 4
+    finally:
+        await scheduler.close()
+
+
+@needs_radio_stack
+@pytest.mark.asyncio
+async def test_injected_scheduler(imports):
+    from radio_scheduler import RadioScheduler
+
+    tl = None
+    scheduler = RadioScheduler(lambda operation: operation(tl))
+    tl = await hue_thief.Touchlink.create(SIM_DEVICE, 115200, scheduler=scheduler, scan_repeats=1)
+    try:
+        # The Touchlink's own scans queue on the scheduler it was given
+        assert [c async for c, targets in tl.scan_channels([11])] == [11]
+        assert scheduler.completed == 1
+    finally:
+        await tl.close()
+    # It belongs to the caller and outlives the radio, e.g. across reconnects
+    try:
+        assert await scheduler.submit(lambda touchlink: asyncio.sleep(0, "alive")) == "alive"
+    finally:
+        await scheduler.close()
+
+@needs_radio_stack
+@pytest.mark.asyncio
+async def test_commands_batched_by_channel(touchlink):
+    from radio_scheduler import COMMAND_PRIORITY
+
+    tl = await touchlink("sim:bulbs=4,channels=11;15,seed=1")
+    targets = [t async for t in hue_thief.scan_targets(tl, [11, 15])]
+    on_11 = [t for t in targets if t.channel == 11]
+    on_15 = [t for t in targets if t.channel == 15]
+    interleaved = [on_11[0], on_15[0], on_11[1], on_15[1]]
+    switches = tl.dev.channel_switches
+    await asyncio.gather(*(
+        tl.submit(lambda tl, t=t: tl.identify_bulb(t.ext_address, t.transaction_id, t.channel),
+                  channel=t.channel, priority=COMMAND_PRIORITY)
+        for t in interleaved
+    ))
+    # Still on 15 from the scan, so 15's bulbs go first and the radio switches once
+    assert tl.dev.channel_switches - switches == 1
+    assert all(bulb.identified == 1 for bulb in tl.dev.bulbs)
+
+
+@needs_server
+def test_commands_cut_into_sweep(server):
+    from concurrent.futures import ThreadPoolExecutor
+    from litestar.testing import TestClient
+
+    # Requests block their caller until answered, so concurrent clients are threads
+    with TestClient(app=server.create_app([SIM_DEVICE], 115200, scan_repeats=1)) as client, \
+            ThreadPoolExecutor(2) as pool:
+        bulb = client.get("/bulbs?channel=11").json()["bulbs"][0]
+        radio = client.app.state.radio
+        tl = radio.touchlink
+        tl.first_response_timeout = 0.05
+        before = len(tl.dev.sent)
+
+        # Two clients asking for a full sweep at once share one
+        sweeps = [pool.submit(client.get, "/bulbs?refresh=true") for _ in range(2)]
+        while not radio.inflight_scans:
+            time.sleep(0.01)
+        time.sleep(0.1)
+        # The identify goes out at the next channel boundary, not after the sweep
+        response = client.post("/identify_bulb", json={"address": bulb["address"]})
+        assert response.status_code == 200
+        assert not any(sweep.done() for sweep in sweeps)
+
+        first, second = [{(b["address"], b["transaction_id"]) for b in sweep.result().json()["bulbs"]} for sweep in sweeps]
+        assert len(first) == 2 and first == second
+        scans = [frame for frame in tl.dev.sent[before:] if interpanZll.scan_req_transaction(frame) is not None]
+        assert len(scans) == len(hue_thief.ALL_CHANNELS)
+        assert sum(bulb.identified for bulb in tl.dev.bulbs) == 1
+
+
+@needs_server
+@pytest.mark.asyncio
+async def test_session_reconnects_once(server):
+    session = server.RadioSession(SIM_DEVICE, 115200, hue_thief.ChannelScheduler(), hue_thief.TargetCache())
+    calls = []
+
+    async def drops_once(touchlink):
+        calls.append(touchlink)
+        if len(calls) == 1:
+            raise ConnectionError("stick unplugged")
+        return await touchlink.scan_channel(11)
+
+    try:
+        # The stick is reopened and the operation retried once on the new one
+        assert len(await session.submit(drops_once, channel=11)) == 2
+        assert len(calls) == 2 and calls[0] is not calls[1]
+        assert session.touchlink is calls[1] and session.touchlink.scheduler is session.scheduler
+
+        # A second failure in a row is the caller's
+        async def always_drops(touchlink):
+            calls.append(touchlink)
+            raise asyncio.TimeoutError()
+
+        with pytest.raises(asyncio.TimeoutError):
+            await session.submit(always_drops)
+        assert len(calls) == 4
+    finally:
+        await session.close()
+
+
+@needs_server
+def test_stream_joins_sweep(server):
+    from concurrent.futures import ThreadPoolExecutor
+    from litestar.testing import TestClient
+
+    with TestClient(app=server.create_app([SIM_DEVICE], 115200, scan_repeats=1)) as client, \
+            ThreadPoolExecutor(1) as pool:
+        assert len(client.get("/bulbs?channel=11").json()["bulbs"]) == 2
+        radio = client.app.state.radio
+        tl = radio.touchlink
+        tl.first_response_timeout = 0.05
+        before = len(tl.dev.sent)
+
+        sweep = pool.submit(client.get, "/bulbs?refresh=true")
+        while not radio.inflight_scans:
+            time.sleep(0.01)
+        time.sleep(0.1)
+        # The stream joins the running sweep, replaying the events it missed
+        events = [block for block in client.get("/bulbs_stream").text.replace("\r\n", "\n").strip().split("\n\n")]
+        kinds = [dict(line.split(": ", 1) for line in block.splitlines() if ": " in line)["event"] for block in events]
+        assert kinds.count("bulb") == 2 and kinds.count("progress") == len(hue_thief.ALL_CHANNELS)
+        assert len(sweep.result().json()["bulbs"]) == 2
+        scans = [frame for frame in tl.dev.sent[before:] if interpanZll.scan_req_transaction(frame) is not None]
+        assert len(scans) == len(hue_thief.ALL_CHANNELS)
+
+
+@needs_server
+@pytest.mark.asyncio
+async def test_several_sticks_route(server):
+    from litestar.testing import AsyncTestClient
+
+    devices = ["sim:bulbs=4,channels=11;15,seed=1", "sim:bulbs=4,channels=11;15,seed=2"]
+    async with AsyncTestClient(app=server.create_app(devices, 115200, scan_repeats=1)) as client:
+        for channel in (11, 15):
+            assert len((await client.get(f"/bulbs?channel={channel}")).json()["bulbs"]) == 2
+        # Each channel was scanned by the stick that owns it
+        radio = client.app.state.radio
+        assert [session.touchlink.dev.channel for session in radio.sessions] == [11, 15]
+
+        # Captures cover both sticks, oldest first
+        captures = (await client.get("/captures")).json()
+        assert captures["total"] == len(captures["frames"]) == 4
+        assert {frame["device"] for frame in captures["frames"]} == set(devices)
+        timestamps = [frame["timestamp"] for frame in captures["frames"]]
+        assert timestamps == sorted(timestamps)
+
+@needs_server
+@pytest.mark.asyncio
+async def test_identify_rescans_stale_transaction(server):
+    from dataclasses import replace
+    from datetime import timedelta
+
+    async with server_client(server) as client:
+        bulb = (await client.get("/bulbs?channel=11")).json()["bulbs"][0]
+        radio = client.app.state.radio
+        cache, dev = radio.target_cache, radio.touchlink.dev
+        # Past the ZLL transaction lifetime the bulb ignores the cached id
+        target = cache.targets[bulb["address"]]
+        cache.targets[bulb["address"]] = replace(target, identified=target.identified - timedelta(seconds=10))
+        before = len(dev.sent)
+
+        response = await client.post("/identify_bulb", json={"address": bulb["address"]})
+        assert response.status_code == 200
+        scans = [frame for frame in dev.sent[before:] if interpanZll.scan_req_transaction(frame) is not None]
+        assert scans and cache.get(bulb["address"]).transaction_valid
+        assert cache.get(bulb["address"]).transaction_id != target.transaction_id
+        assert sum(b.identified for b in dev.bulbs) == 1
+
+
+@needs_server
+@pytest.mark.asyncio
+async def test_bulbs_htmx_rssi(server):
+    async with server_client(server) as client:
+        bulbs = (await client.get("/bulbs?channel=11")).json()["bulbs"]
+        rows = (await client.get("/bulbs_htmx?channel=11")).text
+        # The column is the received signal strength, not the bulb's rSSICorrection
+        assert all(bulb["rssi"] is not None and f"<td>{bulb['rssi']}</td>" in rows for bulb in bulbs)
+
+
+@needs_server
+@pytest.mark.asyncio
+async def test_bulk_routes(server):
+    async with server_client(server, "sim:bulbs=4,channels=11;15,seed=1") as client:
+        bulbs = [bulb for channel in (11, 15) for bulb in (await client.get(f"/bulbs?channel={channel}")).json()["bulbs"]]
+        assert len(bulbs) == 4
+        requested = [{"address": b["address"]} for b in bulbs] + [{"address": "00:00:00:00:00:00:00:01"}]
+
+        results = (await client.post("/identify_bulbs", json={"bulbs": requested})).json()
+        # Failures are reported per bulb, the rest still go out
+        assert [r["ok"] for r in results] == [True] * 4 + [False]
+        dev = client.app.state.radio.touchlink.dev
+        assert all(bulb.identified == 1 for bulb in dev.bulbs)
+
+        results = (await client.post("/reset_bulbs", json={"bulbs": requested[:2]})).json()
+        assert all(r["ok"] for r in results)
+        assert sum(bulb.reset for bulb in dev.bulbs) == 2
+        # Reset bulbs leave their channel, so they are dropped from the cache
+        cache = client.app.state.radio.target_cache
+        assert cache.get(bulbs[0]["address"]) is None and cache.get(bulbs[2]["address"]) is not None
+
+
+@needs_server
+@pytest.mark.asyncio
+async def test_bulbs_stream(server):
+    async with server_client(server) as client:
+        response = await client.get("/bulbs_stream?channel=11")
+        assert response.headers["content-type"].startswith("text/event-stream")
+        events = [
+            dict(line.split(": ", 1) for line in block.splitlines() if ": " in line)
+            for block in response.text.replace("\r\n", "\n").strip().split("\n\n")
+        ]
+        kinds = [e["event"] for e in events]
+        # Each bulb as it answers, then the channel's progress, then done
+        assert kinds == ["bulb", "bulb", "progress", "done"]
+        assert json.loads(events[2]["data"]) == {"channel": 11, "scanned": 1, "total": 1, "found": 2}
+        addresses = {json.loads(e["data"])["address"] for e in events[:2]}
+        assert addresses == {bulb.ext_address for bulb in client.app.state.radio.touchlink.dev.bulbs}
+
+
+def test_metrics_render():
+    import metrics
+
+    registry = metrics.Registry()
+    counter = registry.counter("frames_total", "Frames", ["channel"])
+    histogram = registry.histogram("send_seconds", "Send time", buckets=(0.01, 0.1))
+    counter.inc(11)
+    counter.inc(11, amount=2)
+    counter.inc('a"b')
+    for value in (0.005, 0.05, 5):
+        histogram.observe(value)
+    gauge = metrics.Gauge("queue_depth", "Queued", ["device"])
+    gauge.set(3, "/dev/ttyUSB0")
+
+    lines = registry.render([gauge]).splitlines()
+    assert lines[:2] == ["# HELP frames_total Frames", "# TYPE frames_total counter"]
+    assert 'frames_total{channel="11"} 3' in lines
+    assert 'frames_total{channel="a\\"b"} 1' in lines
+    # Buckets are cumulative and end with +Inf
+    assert 'send_seconds_bucket{le="0.01"} 1' in lines
+    assert 'send_seconds_bucket{le="0.1"} 2' in lines
+    assert 'send_seconds_bucket{le="+Inf"} 3' in lines
+    assert "send_seconds_count 3" in lines and "send_seconds_sum 5.055" in lines
+    assert 'queue_depth{device="/dev/ttyUSB0"} 3' in lines
+
+
+@needs_server
+@pytest.mark.asyncio
+async def test_metrics_route(server):
+    async with server_client(server, scan_repeats=1) as client:
+        await client.get("/bulbs?channel=11")
+        response = await client.get("/metrics")
+        assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+        text = response.text
+        assert f'hue_thief_frames_received_total{{device="{SIM_DEVICE}",channel="11",kind="match"}} 2' in text
+        assert 'hue_thief_sweeps_total{source="radio"}' in text
+        assert f'hue_thief_rx_queue_depth{{device="{SIM_DEVICE}"}} 0' in text
+        assert 'hue_thief_http_request_seconds_count{method="GET",route="/bulbs",status="200"}' in text
+
+
+def test_inventory(tmp_path):
+    from inventory import Inventory
+
+    inventory = Inventory(str(tmp_path / "inventory.db"), history=2)
+    try:
+        bulb = hue_thief.Target("00:0a", 1, 0, 11, rssi=-50, device_id=0x100)
+        inventory.record([bulb], seen=1000.0)
+        inventory.record([hue_thief.Target("00:0a", 2, 0, 15, rssi=-40)], seen=1001.0)
+        inventory.record([bulb], seen=1002.0)
+        inventory.record([hue_thief.Target("00:0b", 3, 0, 20)], seen=1002.0)
+
+        row = inventory.get("00:0a")
+        assert (row["channel"], row["first_seen"], row["last_seen"]) == (11, 1000.0, 1002.0)
+        # ScanResp details survive a response without them
+        assert row["device_id"] == 0x100
+        # Only the newest sightings are kept
+        assert [s["seen"] for s in row["sightings"]] == [1002.0, 1001.0]
+        assert inventory.get("00:0c") is None
+        assert {b["ext_address"] for b in inventory.bulbs()} == {"00:0a", "00:0b"}
+
+        assert inventory.known() == {"00:0a": 11, "00:0b": 20}
+        # Reset bulbs leave their channel, too old ones aren't expected either
+        inventory.mark_reset("00:0b", when=1003.0)
+        assert inventory.known() == {"00:0a": 11}
+        assert inventory.known(max_age=60) == {}
+    finally:
+        inventory.close()
+
+
+@needs_radio_stack
+@pytest.mark.asyncio
+async def test_incremental_sweep(touchlink):
+    tl = await touchlink("sim:bulbs=2,channels=11;15,seed=1", first_response_timeout=0.05)
+    on_11, on_15 = sorted(tl.dev.bulbs, key=lambda bulb: bulb.channel)
+    scanned = []
+
+    async def scan_channels(channels):
+        async for c, targets in tl.scan_channels(channels):
+            scanned.append(c)
+            yield c, targets
+
+    # Every known bulb answers on its channel, nothing else is scanned
+    found = await hue_thief.incremental_sweep(scan_channels, {on_11.ext_address: 11}, [11, 12, 15])
+    assert scanned == [11] and [t.ext_address for t in found] == [on_11.ext_address]
+
+    # A known bulb moved, so the rest of the channels are swept
+    scanned.clear()
+    found = await hue_thief.incremental_sweep(scan_channels, {on_15.ext_address: 11}, [11, 12, 15])
+    assert scanned == [11, 15, 12]
+    assert {t.ext_address for t in found} == {on_11.ext_address, on_15.ext_address}
+
+
+@needs_radio_stack
+@pytest.mark.asyncio
+async def test_replay_capture(imports, tmp_path):
+    from pcap_writer import PcapFormatError
+
+    tl = await hue_thief.Touchlink.create("sim:bulbs=3,channels=11,noise=300,seed=2", 115200)
+    try:
+        targets = await tl.scan_channel(11)
+        live = dict(tl.channel_stats[11])
+        scan_req = next(frame for frame in tl.dev.sent if interpanZll.scan_req_transaction(frame) is not None)
+    finally:
+        await tl.close()
+    assert interpanZll.scan_req_transaction(scan_req) == targets[0].transaction_id
+    assert interpanZll.scan_req_transaction(scan_resp().serialize()) is None
+
+    capture = tmp_path / "log.pcap"
+    # A record cut short, as if the capture was still being written
+    with open(capture, "ab") as f:
+        f.write(bytes(10))
+    stats = hue_thief.replay_pcap([str(capture)])
+    # The repeated ScanReqs of a scan share its transaction
+    repeats = hue_thief.DEFAULT_SCAN_REPEATS
+    assert (stats.scan_requests, stats.transactions) == (repeats, 1)
+    assert set(stats.targets) == {t.ext_address for t in targets}
+    # Classified as it was live, on the channel the responses report. The
+    # capture also holds our ACKs, which replay counts as short frames.
+    assert stats.channel_stats[11]["match"] == live["match"] == 3 * repeats
+    assert stats.channel_stats[11]["not_touchlink"] == live["not_touchlink"]
+
+    (tmp_path / "bad.pcap").write_bytes(bytes(64))
+    with pytest.raises(PcapFormatError):
+        hue_thief.replay_pcap([str(tmp_path / "bad.pcap")])
+
+
+@needs_radio_stack
+@pytest.mark.asyncio
+async def test_rx_queue(imports):
+    from simulated_radio import SimulatedRadio
+
+    dev = SimulatedRadio(send_latency=0)
+    handler = hue_thief.ResponseHandler(dev, None, 15, 0xdeadbeef, max_queue=3)
+    match = scan_resp(seq=0x42).serialize()
+    for data in (match, b"\x41\x88" + bytes(30), scan_resp(transactionId=1).serialize(), match):
+        handler.handle_incoming("mfglibRxHandler", [255, -50, data])
+    handler.handle_incoming("mfglibTxHandler", [0])
+
+    # Nothing decoded inside the callback, the fourth frame didn't fit
+    assert handler.queue_depth == 3 and handler.dropped == 1
+    assert not handler.frame_counts and not handler.targets
+    await asyncio.sleep(0)
+    # Both matching responses were ACKed straight away, even the dropped one
+    assert dev.sent == [interpanZll.ack_for(match)] * 2
+    assert interpanZll.ack_for(match) == interpanZll.AckFrame(seq=0x42).serialize()
+
+    handler.start()
+    await asyncio.wait_for(handler.responded.wait(), 1)
+    assert handler.queue_depth == 0
+    assert handler.frame_counts == {"match": 1, "short": 1, "other_transaction": 1}
+    assert list(handler.targets) == [BULB] and handler.targets[BULB].rssi == -50
+
+    # stop() decodes whatever arrived after the worker's last turn
+    handler.handle_incoming("mfglibRxHandler", [255, -40, match])
+    await handler.stop()
+    assert handler.frame_counts["match"] == 2 and handler.targets[BULB].rssi == -40
+
+
+@needs_radio_stack
+@pytest.mark.asyncio
+async def test_listen_timeouts(touchlink):
+    tl = await touchlink(first_response_timeout=1.0, scan_repeats=1)
+    handler = hue_thief.ResponseHandler(tl.dev, None, 11, 1)
+    start = time.perf_counter()
+    # 0 means don't wait, not the 1s default
+    await tl.listen(handler, first_response_timeout=0)
+    assert time.perf_counter() - start < 0.5
+
+    # Responses keep the window open until the channel goes quiet
+    targets = await tl.scan_channel(11, first_response_timeout=0.5, quiet_period=0.1, max_listen=0)
+    assert targets == []
+    targets = await tl.scan_channel(11, first_response_timeout=0.5, quiet_period=0.1)
+    assert len(targets) == 2
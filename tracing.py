@@ -0,0 +1,154 @@
+"""Span timing for the scan lifecycle and opt-in cProfile captures.
+
+With tracing enabled every span is written as one JSON object per line to
+the "hue_thief.trace" logger: name, id, parent id, trace (root span) id,
+wall-clock start, duration and any attributes. Spans nest through a context
+variable, so a scan_channel span shows where its time went between
+set_channel, send_scan_requests and listen, and each mfglibSendPacket and
+handle_incoming call below it. When disabled, span() is a nullcontext and
+traced() returns the function unchanged.
+
+Profiling writes a .prof file (pstats format, readable by snakeviz,
+gprof2dot or pstats) per profiled run into the configured directory.
+"""
+import contextlib
+import contextvars
+import cProfile
+import itertools
+import json
+import logging
+import os
+import sys
+import time
+
+logger = logging.getLogger("hue_thief.trace")
+
+enabled = False
+profile_dir = None
+
+# (trace id, span id) of the innermost open span
+_current = contextvars.ContextVar("hue_thief_span", default=None)
+_ids = itertools.count(1)
+_profiling = False
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        span = getattr(record, "span", None)
+        if span is None:
+            span = {"message": record.getMessage()}
+        return json.dumps(span, default=str)
+
+
+def enable(path=None, stream=None):
+    """Write spans as JSON lines to path, or to stream (stderr by default)"""
+    global enabled
+    handler = logging.FileHandler(path) if path else logging.StreamHandler(stream or sys.stderr)
+    handler.setFormatter(JsonFormatter())
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    # Keep the JSON lines out of the human readable log
+    logger.propagate = False
+    enabled = True
+
+
+def enable_profiling(directory):
+    global profile_dir
+    os.makedirs(directory, exist_ok=True)
+    profile_dir = directory
+
+
+def current():
+    return _current.get()
+
+
+@contextlib.contextmanager
+def adopt(parent):
+    """Open spans as children of parent, e.g. one captured with current() in another task"""
+    token = _current.set(parent)
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+
+@contextlib.contextmanager
+def _span(name, attrs, parent):
+    span_id = next(_ids)
+    trace_id = parent[0] if parent else span_id
+    token = _current.set((trace_id, span_id))
+    wall = time.time()
+    start = time.perf_counter()
+    error = None
+    try:
+        # The caller can add attributes, e.g. results, while the span is open
+        yield attrs
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        duration = time.perf_counter() - start
+        _current.reset(token)
+        record = {"span": name, "trace": trace_id, "id": span_id, "parent": parent[1] if parent else None,
+                  "start": wall, "duration_s": duration, **attrs}
+        if error:
+            record["error"] = error
+        logger.info(name, extra={"span": record})
+
+
+def span(name, **attrs):
+    """Time the enclosed block as a span, yielding its attribute dict"""
+    if not enabled:
+        return contextlib.nullcontext(attrs)
+    return _span(name, attrs, _current.get())
+
+
+def traced(fn, name, **attrs):
+    """Wrap a callback, e.g. an rx handler, so each call is a span under the currently open one"""
+    if not enabled:
+        return fn
+    parent = _current.get()
+
+    def wrapper(*args, **kwargs):
+        with _span(name, dict(attrs), parent):
+            return fn(*args, **kwargs)
+
+    return wrapper
+
+
+@contextlib.contextmanager
+def profile(name):
+    """cProfile the enclosed block into profile_dir, if profiling is on.
+
+    cProfile follows the whole thread, so other coroutines running on the
+    event loop meanwhile are included. Only one profile runs at a time, a
+    nested or concurrent request just isn't profiled.
+    """
+    global _profiling
+    if profile_dir is None or _profiling:
+        yield None
+        return
+    _profiling = True
+    profiler = cProfile.Profile()
+    path = os.path.join(profile_dir, f"{name}-{time.strftime('%Y%m%d-%H%M%S')}-{next(_ids)}.prof")
+    profiler.enable()
+    try:
+        yield path
+    finally:
+        profiler.disable()
+        _profiling = False
+        profiler.dump_stats(path)
+        logging.getLogger(__name__).info(f"Wrote profile {path}")
+
+
+def add_arguments(parser):
+    parser.add_argument('--trace', action="store_true", help='Log span timings for the scan lifecycle as JSON lines on stderr')
+    parser.add_argument('--trace-file', help='Write the JSON span log to this file instead of stderr')
+    parser.add_argument('--profile', metavar='DIR', help='Save a cProfile .prof of each full scan into DIR')
+
+
+def configure(args):
+    if args.trace or args.trace_file:
+        enable(args.trace_file)
+    if args.profile:
+        enable_profiling(args.profile)